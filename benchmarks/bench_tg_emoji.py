@@ -0,0 +1,242 @@
+"""
+Offline benchmark for the tg_emoji_mcp hot path.
+
+Replaces the pyrogram Client returned by get_tg_client() with SimulatedTelegram, a local stand-in with
+configurable per-RPC latency, payload sizes, FloodWait injection and file_reference expiry, then drives
+search_emoji_auto and search_and_select_emoji (the browser step is auto-confirmed once all cards have
+streamed) across query sizes. All data goes to a temporary directory; nothing touches the real account.
+It also spawns the server as a stdio subprocess to time module import and the first MCP responses.
+
+Usage:
+    python benchmarks/bench_tg_emoji.py --iterations 20 --sizes 1,5,10 --out bench.json
+"""
+
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyrogram
+import tg_emoji_mcp as m
+from pyrogram.raw import functions as F, types as T
+from pyrogram.file_id import FileId
+
+EMOTICONS = ["🔥", "✅", "🚀", "💎", "❤", "😂", "👍", "🎉", "⭐", "💯", "🙏", "😎", "🤖", "⚡", "🍀", "🎯", "👀", "💡", "🥳", "😭"]
+MIMES = ["video/webm", "application/x-tgsticker", "image/webp"]
+
+
+class SimulatedTelegram:
+    """Stand-in for pyrogram.Client covering the calls tg_emoji_mcp makes."""
+
+    def __init__(self, cfg, stats):
+        self.cfg, self.stats, self.rng = cfg, stats, random.Random(cfg.seed)
+        self.is_connected = self.is_initialized = False
+        self.issued = {}  # doc id -> (file_reference, issued_at)
+
+    async def _rpc(self, name, flood=True):
+        self.stats["rpc"][name] += 1
+        await asyncio.sleep(self.cfg.rpc_latency)
+        if flood and self.cfg.flood_rate and self.rng.random() < self.cfg.flood_rate:
+            self.stats["flood_waits"] += 1
+            raise pyrogram.errors.FloodWait(value=self.cfg.flood_seconds)
+
+    async def connect(self):
+        self.stats["rpc"]["connect"] += 1; await asyncio.sleep(self.cfg.connect_latency)
+        self.is_connected = True; return True
+
+    async def disconnect(self): self.is_connected = False
+
+    async def get_me(self): await self._rpc("GetMe", flood=False); return object()
+
+    def _ids(self, em):
+        base = sum(map(ord, em)) * 1000
+        return [base + j for j in range(self.cfg.results)]
+
+    def _doc(self, i):
+        ref = f"ref{time.monotonic_ns()}".encode(); self.issued[i] = (ref, time.monotonic())
+        thumbs = [T.PhotoPathSize(type="j", bytes=bytes(range(1, 60))), T.PhotoSize(type="m", w=100, h=100, size=self.cfg.thumb_kb * 1024)]
+        attrs = [T.DocumentAttributeCustomEmoji(alt="x", stickerset=T.InputStickerSetID(id=1 + i % self.cfg.sets, access_hash=1))]
+        return T.Document(id=i, access_hash=i, file_reference=ref, date=0, mime_type=MIMES[i % 3], size=self.cfg.media_kb * 1024, dc_id=2, attributes=attrs, thumbs=thumbs)
+
+    async def invoke(self, q, **kwargs):
+        await self._rpc(type(q).__name__)
+        if isinstance(q, F.messages.SearchCustomEmoji):
+            h = len(q.emoticon) + self.cfg.results
+            return T.EmojiListNotModified() if q.hash == h else T.EmojiList(hash=h, document_id=self._ids(q.emoticon))
+        if isinstance(q, F.messages.GetCustomEmojiDocuments):
+            if len(q.document_id) > 200: raise pyrogram.errors.BadRequest("too many ids")
+            return [self._doc(i) for i in q.document_id]
+        if isinstance(q, F.messages.GetStickerSet):
+            sid = q.stickerset.id
+            if q.hash == sid: return T.messages.StickerSetNotModified()
+            s = T.StickerSet(id=sid, access_hash=1, title=f"Pack {sid}", short_name=f"pack{sid}", count=0, hash=sid, emojis=True)
+            return T.messages.StickerSet(set=s, packs=[], keywords=[], documents=[])
+        if isinstance(q, F.messages.GetEmojiStickers):
+            return T.messages.AllStickersNotModified() if q.hash == 1 else T.messages.AllStickers(hash=1, sets=[])
+        raise NotImplementedError(type(q).__name__)
+
+    async def download_media(self, file_id, file_name=None, **kwargs):
+        fid = FileId.decode(file_id)
+        self.stats["rpc"]["download_media"] += 1
+        ref, issued_at = self.issued.get(fid.media_id, (None, 0))
+        if fid.file_reference != ref or time.monotonic() - issued_at > self.cfg.ref_ttl:
+            # pyrogram logs FILE_REFERENCE_EXPIRED inside get_file and returns None
+            self.stats["expired_refs"] += 1; await asyncio.sleep(self.cfg.rpc_latency); return None
+        size = (self.cfg.thumb_kb if fid.thumbnail_size else self.cfg.media_kb) * 1024
+        await asyncio.sleep(self.cfg.download_latency + size / (self.cfg.bandwidth_kbps * 1024))
+        body = gzip.compress(b'{"v":"5.5.2","layers":[]}' + b" " * size) if fid.media_id % 3 == 1 and not fid.thumbnail_size else os.urandom(size)
+        with open(file_name, "wb") as f: f.write(body)
+        self.stats["bytes"] += len(body)
+        return file_name
+
+
+def isolate(root):
+    """Points every on-disk store and in-memory cache of tg_emoji_mcp at a fresh, empty directory."""
+    shutil.rmtree(root, ignore_errors=True); os.makedirs(root)
+    m.BASE_DIR = root
+    m.DOWNLOADS_DIR = os.path.join(root, "downloads"); os.makedirs(m.DOWNLOADS_DIR, exist_ok=True)
+    m.MEDIA_DIR = os.path.join(root, "media")
+    m.STICKERSETS_FILE = os.path.join(root, "stickersets.json")
+    m.SEARCH_CACHE_FILE = os.path.join(root, "search_cache.json")
+    m.LOTTIE_JS_FILE = os.path.join(root, "lottie.min.js")
+    m.emoji_index.close(); m.emoji_index = m.EmojiIndex(os.path.join(root, "emoji_index.sqlite3"))
+    m.media_cache = m.MediaCache(m.MEDIA_DIR, m.media_cache.max_bytes)
+    m.stickerset_cache = m.search_cache = None
+    m.doc_cache.clear()
+
+
+async def run_picker(emoticons, limit, stats):
+    """Runs search_and_select_emoji, confirming the first card once every download has streamed."""
+    opened = asyncio.get_running_loop().create_future()
+    m.webbrowser.open = lambda url: opened.done() or opened.set_result((time.perf_counter(), url))
+
+    async def confirm():
+        _, url = await opened
+        session = m.picker_sessions[url.split("/")[-2]]
+        while not session["stream"]["done"]: await session["stream"]["changed"].wait()
+        if not session["future"].done():
+            session["future"].set_result({"selections": [{"id": "0", "query": emoticons[0]}]})
+
+    t0 = time.perf_counter(); task = asyncio.create_task(confirm())
+    res = await m.search_and_select_emoji(emoticons, limit=limit)
+    task.cancel()
+    if opened.done(): stats["ttfp"].append(opened.result()[0] - t0)
+    return res
+
+
+async def run_scenario(cfg, tool, size, warm, root):
+    stats = {"rpc": collections.Counter(), "bytes": 0, "flood_waits": 0, "expired_refs": 0, "lat": [], "ttfp": [], "errors": 0}
+    isolate(root)
+    await m.shutdown()
+    m.load_pyrogram(); m.get_tg_client = lambda: SimulatedTelegram(cfg, stats)
+    m._update_checked = True
+    emoticons = EMOTICONS[:size]
+    tracemalloc.start()
+    for it in range(cfg.iterations + (1 if warm else 0)):
+        if not warm: await m.shutdown(); isolate(root)
+        if warm and it == 0:
+            # Prime caches; not measured
+            await (m.search_emoji_auto(emoticons, limit=cfg.limit) if tool == "auto" else run_picker(emoticons, cfg.limit, {"ttfp": []}))
+            stats.update({"rpc": collections.Counter(), "bytes": 0, "flood_waits": 0, "expired_refs": 0})
+            continue
+        t0 = time.perf_counter()
+        res = await (m.search_emoji_auto(emoticons, limit=cfg.limit) if tool == "auto" else run_picker(emoticons, cfg.limit, stats))
+        stats["lat"].append(time.perf_counter() - t0)
+        if "error" in res: stats["errors"] += 1
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    await m.shutdown()
+    n, lat = cfg.iterations, sorted(stats["lat"])
+    pct = lambda xs, p: round(xs[min(len(xs) - 1, int(p * len(xs)))] * 1000, 2) if xs else None
+    return {
+        "tool": tool, "emoticons": size, "limit": cfg.limit, "cache": "warm" if warm else "cold", "iterations": n,
+        "p50_ms": pct(lat, 0.5), "p95_ms": pct(lat, 0.95), "mean_ms": round(statistics.mean(lat) * 1000, 2),
+        "ttfp_p50_ms": pct(sorted(stats["ttfp"]), 0.5) if stats["ttfp"] else None,
+        "rpc_per_call": {k: round(v / n, 2) for k, v in sorted(stats["rpc"].items())},
+        "bytes_per_call": round(stats["bytes"] / n), "flood_waits": stats["flood_waits"], "expired_refs": stats["expired_refs"],
+        "errors": stats["errors"], "peak_mem_bytes": peak,
+    }
+
+
+async def measure_startup(runs):
+    """Times `import tg_emoji_mcp` and the first MCP responses of a freshly spawned stdio server."""
+    script, PIPE, NULL = os.path.abspath(m.__file__), asyncio.subprocess.PIPE, asyncio.subprocess.DEVNULL
+    samples = {"import_ms": [], "initialize_ms": [], "tools_list_ms": []}
+    with tempfile.TemporaryDirectory(prefix="remoji-startup-") as home:
+        env = {**os.environ, "XDG_DATA_HOME": home, "APPDATA": home, "LOCALAPPDATA": home, "TG_UPDATE_CHECK": "0"}
+        for _ in range(runs):
+            code = "import time; t = time.perf_counter(); import tg_emoji_mcp; print(time.perf_counter() - t)"
+            p = await asyncio.create_subprocess_exec(sys.executable, "-c", code, cwd=os.path.dirname(script), env=env, stdout=PIPE, stderr=NULL)
+            samples["import_ms"].append(float((await p.communicate())[0]))
+
+            t0 = time.perf_counter()
+            p = await asyncio.create_subprocess_exec(sys.executable, script, env=env, stdin=PIPE, stdout=PIPE, stderr=NULL)
+
+            async def call(msg_id, method, params):
+                p.stdin.write((json.dumps({"jsonrpc": "2.0", "id": msg_id, "method": method, "params": params}) + "\n").encode())
+                await p.stdin.drain()
+                while json.loads(await asyncio.wait_for(p.stdout.readline(), 60)).get("id") != msg_id: pass
+
+            await call(1, "initialize", {"protocolVersion": "2024-11-05", "capabilities": {}, "clientInfo": {"name": "bench", "version": "0"}})
+            samples["initialize_ms"].append(time.perf_counter() - t0)
+            p.stdin.write(b'{"jsonrpc": "2.0", "method": "notifications/initialized"}\n')
+            t1 = time.perf_counter(); await call(2, "tools/list", {})
+            samples["tools_list_ms"].append(time.perf_counter() - t1)
+            p.stdin.close(); await p.wait()
+    res = {k: round(statistics.median(v) * 1000, 2) for k, v in samples.items()}
+    print(f"startup import={res['import_ms']}ms initialize={res['initialize_ms']}ms tools/list={res['tools_list_ms']}ms", file=sys.stderr)
+    return {"runs": runs, **res}
+
+
+async def main_async(cfg):
+    m.logger.setLevel("ERROR")
+    startup = await measure_startup(cfg.startup_runs) if cfg.startup_runs else None
+    results = []
+    with tempfile.TemporaryDirectory(prefix="remoji-bench-") as root:
+        for tool in cfg.tools:
+            for size in cfg.sizes:
+                for warm in (False, True):
+                    r = await run_scenario(cfg, tool, size, warm, os.path.join(root, f"{tool}-{size}-{int(warm)}"))
+                    results.append(r)
+                    print(f"{tool:6} n={size:<3} {r['cache']:4} p50={r['p50_ms']}ms p95={r['p95_ms']}ms rpc={sum(r['rpc_per_call'].values()):.1f} bytes={r['bytes_per_call']}", file=sys.stderr)
+    return {"version": m.VERSION, "config": {k: v for k, v in vars(cfg).items() if k != "out"}, "startup": startup, "results": results}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--iterations", type=int, default=10)
+    p.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1, 5, 10], help="emoticons per call")
+    p.add_argument("--tools", type=lambda s: s.split(","), default=["auto", "picker"])
+    p.add_argument("--limit", type=int, default=10)
+    p.add_argument("--results", type=int, default=100, help="documents returned per SearchCustomEmoji")
+    p.add_argument("--sets", type=int, default=20, help="distinct sticker sets across all documents")
+    p.add_argument("--rpc-latency", type=float, default=0.05)
+    p.add_argument("--connect-latency", type=float, default=0.3)
+    p.add_argument("--download-latency", type=float, default=0.08)
+    p.add_argument("--bandwidth-kbps", type=float, default=2048)
+    p.add_argument("--media-kb", type=int, default=24)
+    p.add_argument("--thumb-kb", type=int, default=2)
+    p.add_argument("--flood-rate", type=float, default=0.0, help="probability that an RPC raises FloodWait")
+    p.add_argument("--flood-seconds", type=int, default=3)
+    p.add_argument("--ref-ttl", type=float, default=3600.0, help="seconds before a file_reference expires")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--startup-runs", type=int, default=5, help="server spawns for the start-up timings (0 to skip)")
+    p.add_argument("--out", help="write JSON results here instead of stdout")
+    cfg = p.parse_args()
+    report = asyncio.run(main_async(cfg))
+    if cfg.out:
+        with open(cfg.out, "w", encoding="utf-8") as f: json.dump(report, f, indent=2, ensure_ascii=False)
+    else: print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__": main()
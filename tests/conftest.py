@@ -0,0 +1,29 @@
+import asyncio
+import collections
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import bench_tg_emoji as bench
+import tg_emoji_mcp as m
+
+
+@pytest.fixture
+def tg(tmp_path, monkeypatch):
+    """tg_emoji_mcp pointed at tmp_path and backed by the benchmark's SimulatedTelegram."""
+    cfg = types.SimpleNamespace(results=30, sets=5, rpc_latency=0.001, connect_latency=0.001, download_latency=0.001,
+                                bandwidth_kbps=1024 * 1024, media_kb=4, thumb_kb=1, flood_rate=0.0, flood_seconds=1, ref_ttl=3600.0, seed=1)
+    stats = {"rpc": collections.Counter(), "bytes": 0, "flood_waits": 0, "expired_refs": 0}
+    m.load_pyrogram()
+    bench.isolate(str(tmp_path))
+    monkeypatch.setattr(m, "get_tg_client", lambda: bench.SimulatedTelegram(cfg, stats))
+    monkeypatch.setattr(m, "UPDATE_CHECK", False)
+    monkeypatch.setattr(m, "tg_lock", asyncio.Lock())
+    monkeypatch.setattr(m, "rpc_scheduler", m.RpcScheduler(rate=1000, burst=1000, limits=m.RPC_LIMITS, dc_limit=8, deadline=5.0))
+    yield types.SimpleNamespace(cfg=cfg, stats=stats)
+    m.tg_state.update({"client": None, "authorized": False, "checked_at": 0.0})
+    m.emoji_index.close()
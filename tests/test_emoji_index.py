@@ -0,0 +1,46 @@
+import asyncio
+
+import tg_emoji_mcp as m
+
+
+def auto(*args, **kwargs):
+    async def run():
+        try: return await m.search_emoji_auto(*args, **kwargs)
+        finally: await m.shutdown()
+    return asyncio.run(run())
+
+
+def test_partial_search_is_not_an_index_hit(tg):
+    # Only the first 10 of the 30 search results get indexed, so a larger or filtered query must go to Telegram
+    for em in ("🔥", "💎"):
+        assert auto([em], limit=2)["source"] == "telegram"
+        full = auto([em], limit=10)
+        assert len(full["results"]) == 10
+        res = auto([em], limit=10, prefer_cache=True)
+        assert res["source"] == "index" and res["results"] == full["results"]
+    res = auto(["🔥"], limit=10, is_animated=True, prefer_cache=True)
+    assert res["source"] == "telegram" and len(res["results"]) == 10
+    res = auto(["💎"], limit=20, prefer_cache=True)
+    assert res["source"] == "telegram" and len(res["results"]) == 20
+
+
+def test_fully_indexed_list_answers_short_queries(tg):
+    auto(["🔥"], limit=tg.cfg.results)
+    res = auto(["🔥"], limit=tg.cfg.results, is_animated=True, prefer_cache=True)
+    assert res["source"] == "index"
+    assert len(res["results"]) == len(auto(["🔥"], limit=tg.cfg.results, is_animated=True)["results"])
+
+
+def test_unresolved_pack_names_are_not_an_index_hit(tg):
+    # A filtered query indexes all 30 documents but only resolves the sets of the 2 it returns
+    auto(["🔥"], limit=2, is_animated=True)
+    known = {e["short_name"] for e in m.stickerset_cache.values()}
+    missing = next(f"pack{i}" for i in range(1, tg.cfg.sets + 1) if f"pack{i}" not in known)
+    res = auto(["🔥"], limit=2, pack_name=missing, prefer_cache=True)
+    assert res["source"] == "telegram" and len(res["results"]) == 2
+    res = auto(["🔥"], limit=2, pack_name=missing, prefer_cache=True)
+    assert res["source"] == "index" and len(res["results"]) == 2
+
+
+def test_lookup_skips_unknown_emoticons(tg):
+    assert m.emoji_index.lookup(["💎"], 5) == ({}, {})
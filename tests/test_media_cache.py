@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+
+import tg_emoji_mcp as m
+
+
+def put(cache, key, size=1024):
+    async def download(tmp):
+        with open(tmp, "wb") as f: f.write(b"x" * size)
+        return tmp
+    time.sleep(0.01)  # distinct "used" stamps
+    return asyncio.run(cache.fetch(key, download))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = m.MediaCache(str(tmp_path), 3 * 1024)
+    for k in ("a", "b", "c"): put(cache, k)
+    time.sleep(0.01); assert cache.get("a")
+    put(cache, "d")
+    assert sorted(cache.index) == ["a", "c", "d"] and not os.path.exists(cache.path("b"))
+    assert cache.summary()["evictions"] == 1 and cache.summary()["bytes"] == 3 * 1024
+
+
+def test_fetch_downloads_once(tmp_path):
+    cache, calls = m.MediaCache(str(tmp_path), 1 << 20), []
+
+    async def download(tmp):
+        calls.append(tmp); await asyncio.sleep(0.01)
+        with open(tmp, "wb") as f: f.write(b"x")
+        return tmp
+
+    async def run(): return await asyncio.gather(*(cache.fetch("k", download) for _ in range(5)))
+    assert len(set(asyncio.run(run()))) == 1 and len(calls) == 1
+    assert cache.stats["misses"] == 1 and cache.stats["hits"] == 4
+
+
+def test_processes_sharing_a_directory(tmp_path):
+    a, b = m.MediaCache(str(tmp_path), 1 << 20), m.MediaCache(str(tmp_path), 1 << 20)
+    put(a, "k1")
+    assert b.get("k1") == a.path("k1")  # written by the other process
+    os.unlink(b.path("k1"))  # evicted by the other process
+    assert a.get("k1") is None and "k1" not in a.index
+
+    put(a, "k2"); a.flush()
+    put(b, "k3"); b.flush()
+    merged = m.MediaCache(str(tmp_path), 1 << 20)
+    merged.summary()
+    assert sorted(merged.index) == ["k2", "k3"]
+
+
+def test_only_stale_partial_downloads_are_removed(tmp_path):
+    old, fresh = tmp_path / ".k.1.part.temp", tmp_path / ".k.2.part"
+    old.write_bytes(b"x"); fresh.write_bytes(b"x")
+    stale = time.time() - m.MediaCache.PART_MAX_AGE - 10
+    os.utime(old, (stale, stale))
+    m.MediaCache(str(tmp_path), 1 << 20).summary()
+    assert not old.exists() and fresh.exists()
@@ -0,0 +1,37 @@
+import tg_emoji_mcp as m
+
+
+def test_render_prometheus_text():
+    metrics = m.Metrics()
+    metrics.inc("tg_emoji_cache_requests_total", 3, cache="search", result="hit")
+    metrics.inc("tg_emoji_cache_requests_total", cache="search", result="hit")
+    metrics.inc("tg_emoji_rpc_errors_total", method="Get", error='Bad "x"\n')
+    metrics.observe("tg_emoji_rpc_seconds", 0.2, method="Get")
+    metrics.observe("tg_emoji_rpc_seconds", 3.0, method="Get")
+    lines = metrics.render([("gauge", "tg_emoji_media_cache_bytes", (), 42)]).splitlines()
+
+    assert lines.count("# TYPE tg_emoji_cache_requests_total counter") == 1
+    assert 'tg_emoji_cache_requests_total{cache="search",result="hit"} 4' in lines
+    assert 'tg_emoji_rpc_errors_total{method="Get",error="Bad \\"x\\"\\n"} 1' in lines
+    assert "tg_emoji_media_cache_bytes 42" in lines
+    assert 'tg_emoji_rpc_seconds_bucket{method="Get",le="0.1"} 0' in lines
+    assert 'tg_emoji_rpc_seconds_bucket{method="Get",le="0.25"} 1' in lines
+    assert 'tg_emoji_rpc_seconds_bucket{method="Get",le="5"} 2' in lines
+    assert 'tg_emoji_rpc_seconds_bucket{method="Get",le="+Inf"} 2' in lines
+    assert 'tg_emoji_rpc_seconds_sum{method="Get"} 3.200000' in lines
+    assert 'tg_emoji_rpc_seconds_count{method="Get"} 2' in lines
+    # Each family's samples follow its TYPE line
+    families = [l.split()[2] for l in lines if l.startswith("# TYPE")]
+    assert families == sorted(families)
+
+
+def test_timings_block(tg):
+    import asyncio
+
+    async def run():
+        try: return await m.search_emoji_auto(["🔥"], limit=3, timings=True)
+        finally: await m.shutdown()
+
+    t = asyncio.run(run())["timings"]
+    assert {"ensure_authorized", "search", "documents"} <= set(t["phases_ms"])
+    assert t["rpc"]["SearchCustomEmoji"]["calls"] == 1 and "GetEmojiStickers" not in t["rpc"]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import tg_emoji_mcp as m
+
+
+def run_picker(tg, monkeypatch, emoticons, **kwargs):
+    """Runs search_and_select_emoji, picking the first card once every event has streamed; returns (result, opened)."""
+    opened = []
+
+    async def run():
+        urls = asyncio.Queue()
+        monkeypatch.setattr(m.webbrowser, "open", lambda url: urls.put_nowait(url) or opened.append((url, dict(tg.stats["rpc"]))))
+
+        async def confirm():
+            session = m.picker_sessions[(await urls.get()).split("/")[-2]]
+            while not session["stream"]["done"]: await session["stream"]["changed"].wait()
+            opened.append([json.loads(e) for e in session["stream"]["events"]])
+            first = next(e["id"] for e in opened[-1] if "id" in e)
+            session["future"].set_result({"selections": [{"id": first, "query": emoticons[0]}]})
+
+        task = asyncio.create_task(confirm())
+        try: return await m.search_and_select_emoji(emoticons, **kwargs)
+        finally: task.cancel(); await m.shutdown()
+
+    return asyncio.run(run()), opened
+
+
+def test_page_opens_before_pack_names_resolve(tg, monkeypatch):
+    res, ((url, rpc_at_open), events) = run_picker(tg, monkeypatch, ["🔥", "💎"], limit=3)
+    assert res["status"] == "success"
+    assert rpc_at_open.get("GetStickerSet", 0) == 0 and tg.stats["rpc"]["GetStickerSet"] > 0
+    packs = next(e["packs"] for e in events if "packs" in e)
+    cards = [e["id"] for e in events if "src" in e]
+    assert len(cards) == 6 and set(packs) == set(cards) and all(n.startswith("pack") for n in packs.values())
+
+
+def test_pack_filter_still_applies_before_the_page_opens(tg, monkeypatch):
+    res, ((url, rpc_at_open), events) = run_picker(tg, monkeypatch, ["🔥"], limit=3, pack_name="pack2")
+    assert rpc_at_open["GetStickerSet"] > 0
+    assert set(next(e["packs"] for e in events if "packs" in e).values()) == {"pack2"}
+
+
+def test_concurrent_pickers_share_one_web_server(tg, monkeypatch):
+    serve_web, started = m.serve_web, []
+
+    async def slow_serve_web():
+        # Widen the window in which a second picker could find no server yet
+        started.append(1); await asyncio.sleep(0.05)
+        return await serve_web()
+    monkeypatch.setattr(m, "serve_web", slow_serve_web)
+
+    async def run():
+        urls = asyncio.Queue()
+        monkeypatch.setattr(m.webbrowser, "open", lambda url: urls.put_nowait(url))
+        tools = [asyncio.create_task(m.search_and_select_emoji([em], limit=2)) for em in ("🔥", "💎")]
+        opened = [await urls.get() for _ in tools]
+        for url in opened: m.picker_sessions[url.split("/")[-2]]["future"].set_result({"selections": []})
+        await asyncio.gather(*tools)
+        runner = m.web_app_runner
+        await m.shutdown()
+        return opened, runner
+
+    opened, runner = asyncio.run(run())
+    assert len(started) == 1 and len({url.split("/")[2] for url in opened}) == 1
+    assert runner is not None and m.web_app_runner is None and m.web_server_task is None
@@ -0,0 +1,28 @@
+import base64
+import re
+import types
+
+import tg_emoji_mcp as m
+
+m.load_pyrogram()
+
+
+def doc(*thumbs): return types.SimpleNamespace(thumbs=list(thumbs))
+
+
+def test_stripped_thumbnail_becomes_a_jpeg():
+    html = m.inline_preview_html(doc(m.PhotoStrippedSize(type="i", bytes=b"\x01\x28\x1e" + b"scan")))
+    jpg = base64.b64decode(re.search(r"base64,([^']+)", html).group(1))
+    assert jpg.startswith(b"\xff\xd8") and jpg.endswith(b"scan\xff\xd9")
+    assert (jpg[164], jpg[166]) == (0x28, 0x1e)
+    assert len(jpg) == len(m.STRIPPED_JPEG_HEADER) + 4 + 2
+
+
+def test_vector_outline_is_preferred():
+    path = m.PhotoPathSize(type="j", bytes=bytes([5, 70, 130, 200]))
+    html = m.inline_preview_html(doc(m.PhotoStrippedSize(type="i", bytes=b"\x01\x01\x01x"), path))
+    assert f"d='M5-6,2{m.SVG_PATH_LOOKUP[8]}z'" in html
+
+
+def test_no_embedded_thumbnail():
+    assert m.inline_preview_html(doc()) == "<div class='ph'></div>"
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import tg_emoji_mcp as m
+
+m.load_pyrogram()
+FloodWait = m.pyrogram.errors.FloodWait
+
+
+def scheduler(deadline=5.0):
+    return m.RpcScheduler(rate=1000, burst=1000, limits={"default": 4}, dc_limit=4, deadline=deadline)
+
+
+def flaky(*outcomes):
+    """Returns a call that raises or returns the given outcomes in order, counting invocations."""
+    outcomes = list(outcomes)
+    async def call():
+        call.n += 1; o = outcomes.pop(0)
+        if isinstance(o, BaseException): raise o
+        return o
+    call.n = 0
+    return call
+
+
+def test_flood_wait_within_deadline_is_retried():
+    s = scheduler(); call = flaky(FloodWait(value=1), "ok")
+    assert asyncio.run(s.run("GetStickerSet", call)) == "ok"
+    assert call.n == 2 and s.stats["flood_waits"] == 1 and s.stats["retries"] == 1
+    assert s.slot("GetStickerSet").cur == 2
+
+
+def test_flood_wait_past_deadline_is_deferred_and_blocks_the_method():
+    s, issues = scheduler(deadline=1.0), []
+
+    async def run():
+        m.rpc_issues.set(issues)
+        with pytest.raises(FloodWait): await s.run("SearchCustomEmoji", flaky(FloodWait(value=60)), item="🔥")
+        # The method stays blocked, so the next call is deferred without reaching Telegram
+        call = flaky("ok")
+        with pytest.raises(FloodWait): await s.run("SearchCustomEmoji", call, item="💎")
+        assert call.n == 0
+        assert await s.run("GetStickerSet", flaky("ok")) == "ok"
+
+    asyncio.run(run())
+    assert [(i["status"], i["item"]) for i in issues] == [("deferred", "🔥"), ("deferred", "💎")]
+    assert s.stats["deferred"] == 2
+
+
+def test_tool_results_list_deferred_items():
+    @m.report_rpc_issues
+    async def tool():
+        m.report_issue("deferred", "SearchCustomEmoji", "🔥", retry_after=60)
+        m.report_failure("GetStickerSet", 1, ValueError("boom"))
+        m.report_failure("GetStickerSet", 2, FloodWait(value=5))  # already reported as deferred by the scheduler
+        return {"status": "success"}
+
+    res = asyncio.run(tool())
+    assert res["deferred"] == [{"method": "SearchCustomEmoji", "item": "🔥", "retry_after": 60}]
+    assert res["failed"] == [{"method": "GetStickerSet", "item": "1", "error": "boom"}]
+
+
+def test_adaptive_limit_caps_concurrency_and_recovers():
+    limit, active, peak = m.AdaptiveLimit(3), [0], [0]
+
+    async def work():
+        async with limit:
+            active[0] += 1; peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.01); active[0] -= 1
+
+    async def run(): await asyncio.gather(*(work() for _ in range(10)))
+    asyncio.run(run())
+    assert peak[0] == 3
+
+    limit.shrink(); assert limit.cur == 1
+    for _ in range(20): limit.success()
+    assert limit.cur == 2
+
+
+def test_simulated_flood_waits_are_retried(tg):
+    tg.cfg.flood_rate, tg.cfg.flood_seconds = 0.5, 0
+
+    async def run():
+        try: return await m.search_emoji_auto(["🔥", "💎"], limit=3)
+        finally: await m.shutdown()
+
+    res = asyncio.run(run())
+    assert len(res["results"]) == 6 and "deferred" not in res
+    assert tg.stats["flood_waits"] > 0 and m.rpc_scheduler.stats["retries"] == tg.stats["flood_waits"]
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter: the other tests import pyrogram on the main thread, which would hide how the
+# server's start-up pre-warm imports it
+SCRIPT = """
+import asyncio, collections, sys, tempfile, types
+import tg_emoji_mcp as m
+
+async def main():
+    async with m.lifespan(None):
+        await m.prewarm_task
+        sys.path.insert(0, "benchmarks"); import bench_tg_emoji as bench
+        cfg = types.SimpleNamespace(results=30, sets=5, rpc_latency=0.001, connect_latency=0.001, download_latency=0.001,
+                                    bandwidth_kbps=1 << 20, media_kb=4, thumb_kb=1, flood_rate=0.3, flood_seconds=0, ref_ttl=3600.0, seed=1)
+        stats = {"rpc": collections.Counter(), "bytes": 0, "flood_waits": 0, "expired_refs": 0}
+        bench.isolate(tempfile.mkdtemp()); m.get_tg_client = lambda: bench.SimulatedTelegram(cfg, stats)
+        res = await m.search_emoji_auto(["🔥", "💎"], limit=3)
+        assert stats["flood_waits"] and len(res.get("results", [])) == 6 and "failed" not in res, res
+        assert m.pyrogram.errors.SessionPasswordNeeded
+
+asyncio.run(main())
+"""
+
+
+def test_tool_call_after_server_start_up():
+    env = {**os.environ, "TG_UPDATE_CHECK": "0", "TG_PREWARM": "0"}
+    p = subprocess.run([sys.executable, "-c", SCRIPT], cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    assert p.returncode == 0, p.stderr[-2000:]
+
+PREWARM_SCRIPT = """
+import asyncio
+import tg_emoji_mcp as m
+
+class Client:
+    is_connected = False
+    async def connect(self): self.is_connected = True; return True
+    async def get_me(self): return object()
+    async def disconnect(self): self.is_connected = False
+
+async def main():
+    m.get_tg_client = lambda: (m.load_pyrogram(), Client())[1]
+    m.start_index_refresh = lambda: None
+    async with m.lifespan(None):
+        await m.prewarm_task
+        assert m.tg_state["authorized"] and m.tg_state["client"].is_connected
+
+asyncio.run(main())
+"""
+
+
+def test_prewarm_connects():
+    env = {**os.environ, "TG_UPDATE_CHECK": "0", "TG_PREWARM": "1"}
+    p = subprocess.run([sys.executable, "-c", PREWARM_SCRIPT], cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    assert p.returncode == 0, p.stderr[-2000:]
@@ -10,36 +10,56 @@
 # ///
 
 import asyncio
-import pyrogram
 import os
-import gzip
 import webbrowser
 import logging
 import sys
 import json
 import re
 import shutil
-from aiohttp import web, ClientSession
-from mcp.server.fastmcp import FastMCP
-from pyrogram import Client
-from pyrogram.raw.functions.messages import SearchCustomEmoji, GetCustomEmojiDocuments
-from pyrogram.raw.functions.account import GetPassword
-from pyrogram.raw.types import EmojiList
-from pyrogram.file_id import FileId, FileType
+import time
+import uuid
+import base64
+import sqlite3
+import functools
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv, set_key
 from platformdirs import user_data_dir
 
+# pyrogram, aiohttp and mcp are nearly all of the start-up time, so they are imported on first use
+def load_pyrogram():
+    global pyrogram, Client, SearchCustomEmoji, GetCustomEmojiDocuments, GetStickerSet, GetEmojiStickers, GetPassword
+    global EmojiList, EmojiListNotModified, InputStickerSetID, StickerSetNotModified, AllStickersNotModified
+    global PhotoSize, PhotoStrippedSize, PhotoPathSize, FileId, FileType, ThumbnailSource
+    import pyrogram
+    from pyrogram import Client
+    from pyrogram.raw.functions.messages import SearchCustomEmoji, GetCustomEmojiDocuments, GetStickerSet, GetEmojiStickers
+    from pyrogram.raw.functions.account import GetPassword
+    from pyrogram.raw.types import EmojiList, EmojiListNotModified, InputStickerSetID
+    from pyrogram.raw.types.messages import StickerSetNotModified, AllStickersNotModified
+    from pyrogram.raw.types import PhotoSize, PhotoStrippedSize, PhotoPathSize
+    from pyrogram.file_id import FileId, FileType, ThumbnailSource
+
+def load_aiohttp():
+    global web, ClientSession
+    from aiohttp import web, ClientSession
+
 # Version 0.4.4 - High-speed parallel search and download
 VERSION = "0.4.4"
 PACKAGE_NAME = "remoji-tg-mcp"
 
 # --- Paths ---
 BASE_DIR = user_data_dir(PACKAGE_NAME, "Rerowros")
-os.makedirs(BASE_DIR, exist_ok=True)
 ENV_FILE = os.path.join(BASE_DIR, ".env")
 DOWNLOADS_DIR = os.path.join(BASE_DIR, "downloads")
 SESSION_FILE = os.path.join(BASE_DIR, "user_session")
-os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+STICKERSETS_FILE = os.path.join(BASE_DIR, "stickersets.json")
+MEDIA_DIR = os.path.join(BASE_DIR, "media")
+LOTTIE_JS_FILE = os.path.join(BASE_DIR, "lottie.min.js")
+LOTTIE_JS_URL = "https://cdnjs.cloudflare.com/ajax/libs/bodymovin/5.12.2/lottie.min.js"
+SEARCH_CACHE_FILE = os.path.join(BASE_DIR, "search_cache.json")
+INDEX_FILE = os.path.join(BASE_DIR, "emoji_index.sqlite3")
 
 # --- Encoding ---
 if sys.platform == "win32":
@@ -57,40 +77,684 @@ logger.setLevel(logging.INFO)
 for l in ["pyrogram", "asyncio", "aiohttp"]: logging.getLogger(l).setLevel(logging.WARNING)
 
 load_dotenv(ENV_FILE)
-mcp = FastMCP("TelegramEmojiSearch")
 
-selected_emoji_future = None
+@asynccontextmanager
+async def lifespan(server):
+    # A fixed WEB_PORT starts the web server up front so /metrics can be scraped before any tool call
+    if os.environ.get("WEB_PORT"): await start_web_server()
+    start_update_check(); start_prewarm()
+    try: yield
+    finally: await shutdown()
+
+_server = None
+
 config_update_future = None
 web_app_runner = None
 web_server_port = None
+web_server_task = None
+
+# Set TG_UPDATE_CHECK=0 to skip the PyPI version check; it never delays a tool call either way
+UPDATE_CHECK = os.environ.get("TG_UPDATE_CHECK", "1") != "0"
 _update_checked = False
+update_task = None
+
+# Set TG_PREWARM=1 to connect to Telegram in the background as soon as the server starts
+PREWARM = os.environ.get("TG_PREWARM", "0") == "1"
+prewarm_task = None
 
 auth_session = {
     "client": None, "phone": None, "phone_code_hash": None,
     "step": "config", "error": None, "pwd_hint": None
 }
 
+# Shared Telegram connection, reused by every tool call
+CLIENT_HEALTH_INTERVAL = 60.0
+tg_state = {"client": None, "authorized": False, "checked_at": 0.0}
+tg_lock = asyncio.Lock()
+
+# Sticker-set short names keyed by set id; revalidated by hash after the TTL
+STICKERSET_TTL = 24 * 3600
+stickerset_cache = None
+
+# Custom-emoji Document objects keyed by document id (most recently used last)
+DOC_CHUNK = 100
+DOC_CACHE_MAX = 10000
+doc_cache = {}
+
+# Open picker pages keyed by session id: {"id", "dir", "future", "stream"}
+PICKER_TIMEOUT = 300.0
+picker_sessions = {}
+
+# Installed emoji packs are re-synced into the offline index in the background
+INDEX_REFRESH_INTERVAL = 6 * 3600
+index_refresh_task = None
+
+# SearchCustomEmoji results keyed by emoticon: {"hash": int, "ids": [int]}
+SEARCH_CACHE_PERSIST = os.environ.get("SEARCH_CACHE_PERSIST", "1") != "0"
+search_cache = None
+
 # --- Utils ---
 
-def cleanup_downloads():
+def cleanup_downloads(max_age=0):
+    """Removes staging entries older than max_age seconds, so pages of other live server processes survive."""
     if os.path.exists(DOWNLOADS_DIR):
         for f in os.listdir(DOWNLOADS_DIR):
             try:
                 p = os.path.join(DOWNLOADS_DIR, f)
+                if time.time() - os.path.getmtime(p) < max_age: continue
                 if os.path.isfile(p): os.unlink(p)
                 elif os.path.isdir(p): shutil.rmtree(p)
             except: pass
 
+def load_json(path, default):
+    try:
+        with open(path, encoding="utf-8") as f: return json.load(f)
+    except Exception: return default
+
+def save_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception as e: logger.warning(f"Failed to write {path}: {e}")
+
+class MediaCache:
+    """Persistent media store keyed by document id + extension, bounded by a byte budget with LRU eviction.
+
+    Several server processes may share the directory: lookups stat the file instead of trusting the index,
+    and flush merges the on-disk index rather than overwriting it.
+    """
+
+    PART_MAX_AGE = 3600
+
+    def __init__(self, root, max_bytes):
+        self.root, self.max_bytes = root, max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        self.index, self.dirty, self.locks = None, False, {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "downloaded_bytes": 0}
+
+    def _load(self):
+        if self.index is not None: return
+        os.makedirs(self.root, exist_ok=True)
+        present, idx, now = set(os.listdir(self.root)), load_json(self.index_path, {}), time.time()
+        for f in present:
+            # Our partial downloads and pyrogram's .temp files; recent ones may still be written by another process
+            if f.endswith((".part", ".part.temp")):
+                try:
+                    if now - os.path.getmtime(self.path(f)) > self.PART_MAX_AGE: os.unlink(self.path(f))
+                except OSError: pass
+        self.index = {k: v for k, v in idx.items() if k in present}
+
+    def path(self, key): return os.path.join(self.root, key)
+
+    def get(self, key):
+        self._load(); e = self.index.get(key)
+        try: size = os.path.getsize(self.path(key))
+        except OSError:
+            # Evicted by another process sharing the directory
+            if e: del self.index[key]; self.dirty = True
+            return None
+        if not e: e = self.index[key] = {"size": size}
+        e["used"] = time.time(); self.dirty = True
+        return self.path(key)
+
+    async def fetch(self, key, download):
+        """Returns the cached path for key, calling `await download(tmp_path)` on a miss."""
+        if p := self.get(key): self.stats["hits"] += 1; return p
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            if p := self.get(key): self.stats["hits"] += 1; return p
+            self.stats["misses"] += 1
+            tmp = self.path(f".{key}.{uuid.uuid4().hex}.part")
+            try:
+                if not await download(tmp) or not os.path.exists(tmp): return None
+                os.replace(tmp, self.path(key))
+            finally:
+                if os.path.exists(tmp): os.unlink(tmp)
+                self.locks.pop(key, None)
+            self.index[key] = {"size": os.path.getsize(self.path(key)), "used": time.time()}
+            self.stats["downloaded_bytes"] += self.index[key]["size"]; self.dirty = True; self._evict(keep=key)
+            return self.path(key)
+
+    def _evict(self, keep=None):
+        total = sum(e["size"] for e in self.index.values())
+        for k, e in sorted(self.index.items(), key=lambda kv: kv[1]["used"]):
+            if total <= self.max_bytes: break
+            if k == keep: continue
+            try: os.unlink(self.path(k))
+            except FileNotFoundError: pass
+            except OSError: continue
+            del self.index[k]; total -= e["size"]; self.stats["evictions"] += 1
+
+    def flush(self):
+        """Writes the index merged with the one on disk, keeping entries other processes added since we loaded it."""
+        if self.index is None or not self.dirty: return
+        for k, e in load_json(self.index_path, {}).items():
+            mine = self.index.get(k)
+            if (not mine or e.get("used", 0) > mine["used"]) and os.path.exists(self.path(k)): self.index[k] = e
+        self._evict(); save_json(self.index_path, self.index); self.dirty = False
+
+    def summary(self):
+        self._load()
+        return {**self.stats, "entries": len(self.index), "bytes": sum(e["size"] for e in self.index.values()), "max_bytes": self.max_bytes}
+
+class EmojiIndex:
+    """Offline emoticon -> document index in SQLite, filled from searches and the account's installed emoji packs."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS emoji (emoticon TEXT, doc_id INTEGER, rank INTEGER, source TEXT, PRIMARY KEY (emoticon, doc_id));
+        CREATE TABLE IF NOT EXISTS docs (doc_id INTEGER PRIMARY KEY, set_id INTEGER, pack TEXT, mime TEXT, animated INTEGER);
+        CREATE TABLE IF NOT EXISTS updated (emoticon TEXT PRIMARY KEY, updated_at REAL);
+        CREATE TABLE IF NOT EXISTS sets (set_id INTEGER PRIMARY KEY, hash INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS coverage (emoticon TEXT PRIMARY KEY, indexed INTEGER, total INTEGER);
+    """
+
+    def __init__(self, path): self.path, self._db = path, None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path); self._db.executescript(self.SCHEMA)
+        return self._db
+
+    @staticmethod
+    def norm(em): return em.replace("\ufe0f", "")
+
+    def _doc_rows(self, docs, pack_of):
+        return [(d.id, getattr(doc_stickerset(d), 'id', None), pack_of(d), getattr(d, 'mime_type', ''), int(doc_is_animated(d))) for d in docs]
+
+    def add_search(self, query_to_ids):
+        """Records the leading part of each search result list whose metadata is cached, and how much of the list that is."""
+        now, db = time.time(), self.db
+        known = {sid: e["short_name"] for sid, e in (stickerset_cache or {}).items()}
+        with db:
+            for em, ids in query_to_ids.items():
+                em = self.norm(em)
+                covered = next((n for n, i in enumerate(ids) if i not in doc_cache), len(ids)); docs = [doc_cache[i] for i in ids[:covered]]
+                db.execute("DELETE FROM emoji WHERE emoticon = ? AND source = 'search'", (em,))
+                db.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)", self._doc_rows(docs, lambda d: known.get(str(getattr(doc_stickerset(d), 'id', None)))))
+                db.executemany("INSERT OR REPLACE INTO emoji VALUES (?, ?, ?, 'search')", [(em, d.id, r) for r, d in enumerate(docs)])
+                db.execute("INSERT OR REPLACE INTO updated VALUES (?, ?)", (em, now))
+                db.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)", (em, covered, len(ids)))
+
+    def add_set(self, full):
+        """Records a messages.StickerSet: its documents and every emoticon -> document pack entry."""
+        now, db, s = time.time(), self.db, full.set
+        with db:
+            db.execute("DELETE FROM emoji WHERE source = 'pack' AND doc_id IN (SELECT doc_id FROM docs WHERE set_id = ?)", (s.id,))
+            db.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)", self._doc_rows(full.documents, lambda d: s.short_name))
+            rows = [(self.norm(p.emoticon), doc_id, 100000 + r, 'pack') for p in full.packs for r, doc_id in enumerate(p.documents)]
+            db.executemany("INSERT OR IGNORE INTO emoji VALUES (?, ?, ?, ?)", rows)
+            db.executemany("INSERT OR REPLACE INTO updated VALUES (?, ?)", [(em, now) for em in {r[0] for r in rows}])
+            db.execute("INSERT OR REPLACE INTO sets VALUES (?, ?)", (s.id, s.hash))
+
+    def drop_sets_except(self, set_ids):
+        with self.db as db:
+            gone = [r[0] for r in db.execute("SELECT set_id FROM sets") if r[0] not in set_ids]
+            for sid in gone:
+                db.execute("DELETE FROM emoji WHERE source = 'pack' AND doc_id IN (SELECT doc_id FROM docs WHERE set_id = ?)", (sid,))
+                db.execute("DELETE FROM sets WHERE set_id = ?", (sid,))
+
+    def add_pack_names(self, names):
+        """Fills in pack names for documents recorded before their sticker set was resolved."""
+        with self.db as db: db.executemany("UPDATE docs SET pack = ? WHERE set_id = ? AND pack IS NULL", [(n, sid) for sid, n in names.items()])
+
+    def set_hash(self, set_id):
+        r = self.db.execute("SELECT hash FROM sets WHERE set_id = ?", (set_id,)).fetchone()
+        return r[0] if r else None
+
+    def meta(self, key, value=None):
+        if value is None:
+            r = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return r[0] if r else None
+        with self.db as db: db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def lookup(self, emoticons, limit, pack_name=None, is_animated=None):
+        """Returns ({emoticon: [(doc_id, pack, animated)]}, {emoticon: age_seconds}) for emoticons the index fully answers.
+
+        That is when `limit` rows match, or fewer do but the emoticon's whole search result list is indexed.
+        A pack_name filter also needs the pack of every indexed search result, since unresolved ones cannot match.
+        """
+        sql = "SELECT e.doc_id, d.pack, d.animated FROM emoji e JOIN docs d USING (doc_id) WHERE e.emoticon = ?"
+        args = []
+        if is_animated is not None: sql += " AND d.animated = ?"; args.append(int(is_animated))
+        if pack_name: sql += " AND instr(lower(d.pack), ?) > 0"; args.append(pack_name.lower())
+        sql += " ORDER BY e.rank LIMIT ?"
+        results, ages, now = {}, {}, time.time()
+        for em in emoticons:
+            r = self.db.execute("SELECT updated_at FROM updated WHERE emoticon = ?", (self.norm(em),)).fetchone()
+            if not r: continue
+            rows = [(i, p or "", bool(a)) for i, p, a in self.db.execute(sql, (self.norm(em), *args, limit))]
+            c = self.db.execute("SELECT indexed, total FROM coverage WHERE emoticon = ?", (self.norm(em),)).fetchone()
+            if len(rows) < limit and not (c and c[0] >= c[1]): continue
+            if pack_name and self.db.execute("SELECT 1 FROM emoji e JOIN docs d USING (doc_id) WHERE e.emoticon = ? AND e.source = 'search' AND d.pack IS NULL LIMIT 1", (self.norm(em),)).fetchone(): continue
+            ages[em], results[em] = round(now - r[0]), rows
+        return results, ages
+
+    def close(self):
+        if self._db is not None: self._db.close(); self._db = None
+
+emoji_index = EmojiIndex(INDEX_FILE)
+
+# --- Metrics ---
+TIME_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120)
+
+class Metrics:
+    """Process-wide counters and latency histograms, rendered in the Prometheus text format on /metrics."""
+
+    def __init__(self): self.counters, self.histograms = {}, {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items())); self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        h = self.histograms.setdefault((name, tuple(labels.items())), [0] * len(TIME_BUCKETS) + [0, 0.0])
+        for i, b in enumerate(TIME_BUCKETS):
+            if seconds <= b: h[i] += 1
+        h[-2] += 1; h[-1] += seconds
+
+    @staticmethod
+    def _labels(labels):
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}" if labels else ""
+
+    def render(self, extra=()):
+        """Renders every series; `extra` holds (type, name, labels, value) samples read at scrape time."""
+        families = {}
+        def add(kind, name, line): families.setdefault(name, (kind, []))[1].append(line)
+        for (name, labels), v in self.counters.items(): add("counter", name, f"{name}{self._labels(labels)} {v}")
+        for kind, name, labels, v in extra: add(kind, name, f"{name}{self._labels(labels)} {v}")
+        for (name, labels), h in self.histograms.items():
+            for b, n in zip((*TIME_BUCKETS, "+Inf"), h[:-1]): add("histogram", name, f"{name}_bucket{self._labels(labels + (('le', b),))} {n}")
+            add("histogram", name, f"{name}_sum{self._labels(labels)} {h[-1]:.6f}"); add("histogram", name, f"{name}_count{self._labels(labels)} {h[-2]}")
+        return "".join(f"# TYPE {name} {kind}\n" + "".join(l + "\n" for l in lines) for name, (kind, lines) in sorted(families.items()))
+
+metrics = Metrics()
+
+# Per-phase and per-method time spent by the current tool call: {"phase": {name: [count, seconds]}, "rpc": {...}}
+call_timings = contextvars.ContextVar("call_timings", default=None)
+
+def record_time(kind, name, seconds):
+    metrics.observe(f"tg_emoji_{kind}_seconds", seconds, **{"method" if kind == "rpc" else kind: name})
+    if (t := call_timings.get()) is not None:
+        e = t[kind].setdefault(name, [0, 0.0]); e[0] += 1; e[1] += seconds
+
+@contextmanager
+def span(phase):
+    """Times a phase of the current tool call into /metrics and the call's timings block."""
+    start = time.perf_counter()
+    try: yield
+    finally: record_time("phase", phase, time.perf_counter() - start)
+
+def traced(fn):
+    """Times a tool call and, when it is called with timings=True, adds a `timings` block to its result."""
+    ms = lambda s: round(s * 1000, 1)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        trace = {"phase": {}, "rpc": {}}; token = call_timings.set(trace); start = time.perf_counter()
+        try: res = await fn(*args, **kwargs)
+        finally: call_timings.reset(token); total = time.perf_counter() - start
+        record_time("tool", fn.__name__, total)
+        metrics.inc("tg_emoji_tool_calls_total", tool=fn.__name__, status="error" if "error" in res else "ok")
+        if kwargs.get("timings"):
+            # RPCs and downloads overlap, so their times add up to more than the phase that ran them
+            res["timings"] = {"total_ms": ms(total), "phases_ms": {k: ms(s) for k, (n, s) in trace["phase"].items()},
+                              "rpc": {k: {"calls": n, "ms": ms(s)} for k, (n, s) in trace["rpc"].items()}}
+        return res
+    return wrapper
+
+# Items deferred by FloodWait or failed for good during the current tool call
+rpc_issues = contextvars.ContextVar("rpc_issues", default=None)
+
+def report_issue(status, method, item, **extra):
+    issues = rpc_issues.get()
+    if issues is not None and item is not None: issues.append({"status": status, "method": method, "item": str(item), **extra})
+
+def report_failure(method, item, e):
+    """Records an item we gave up on; FloodWait deferrals were already recorded by the scheduler."""
+    if not isinstance(e, pyrogram.errors.FloodWait): report_issue("failed", method, item, error=str(e))
+
+def report_rpc_issues(fn):
+    """Adds `deferred` / `failed` item lists to a tool's result when the scheduler could not complete them."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        issues = []; token = rpc_issues.set(issues)
+        try: res = await fn(*args, **kwargs)
+        finally: rpc_issues.reset(token)
+        for status in ("deferred", "failed"):
+            if items := [{k: v for k, v in i.items() if k != "status"} for i in issues if i["status"] == status]: res[status] = items
+        return res
+    return wrapper
+
+def detached(coro):
+    """Runs coro as a task outside the current tool call, so it does not charge timings or issues to that call."""
+    async def run():
+        call_timings.set(None); rpc_issues.set(None); return await coro
+    return asyncio.create_task(run())
+
+class AdaptiveLimit:
+    """Concurrency limit that halves on FloodWait and grows back by one after a run of successes."""
+
+    def __init__(self, limit):
+        self.max = self.cur = limit
+        self.active = self.streak = 0
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.cur); self.active += 1
+
+    async def __aexit__(self, *exc):
+        async with self.cond:
+            self.active -= 1; self.cond.notify_all()
+
+    def shrink(self): self.cur, self.streak = max(1, self.cur // 2), 0
+
+    def success(self):
+        self.streak += 1
+        if self.cur < self.max and self.streak >= 20: self.cur, self.streak = self.cur + 1, 0
+
+class RpcScheduler:
+    """Runs every Telegram call under per-method and per-DC limits, token-bucket pacing and FloodWait backoff.
+
+    A FloodWait blocks the whole method for the requested time and halves its concurrency; the call is
+    retried while the wait fits in its deadline, otherwise it is reported as deferred and re-raised.
+    """
+
+    def __init__(self, rate, burst, limits, dc_limit, deadline):
+        self.rate, self.burst, self.tokens, self.stamp = rate, burst, float(burst), time.monotonic()
+        self.limits, self.dc_limit, self.deadline = limits, dc_limit, deadline
+        self.slots, self.dc_slots, self.blocked_until = {}, {}, {}
+        self.stats = {"calls": 0, "retries": 0, "flood_waits": 0, "deferred": 0}
+
+    def slot(self, method): return self.slots.setdefault(method, AdaptiveLimit(self.limits.get(method, self.limits["default"])))
+
+    def dc_slot(self, dc): return self.dc_slots.setdefault(dc, AdaptiveLimit(self.dc_limit))
+
+    async def _pace(self):
+        while True:
+            now = time.monotonic()
+            self.tokens, self.stamp = min(self.burst, self.tokens + (now - self.stamp) * self.rate), now
+            if self.tokens >= 1: self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def run(self, method, call, dc="main", item=None, paced=True):
+        end = time.monotonic() + self.deadline
+        while True:
+            if (wait := self.blocked_until.get(method, 0) - time.monotonic()) > 0:
+                if time.monotonic() + wait > end:
+                    self.stats["deferred"] += 1; report_issue("deferred", method, item, retry_after=round(wait))
+                    raise pyrogram.errors.FloodWait(value=round(wait))
+                await asyncio.sleep(wait)
+            if paced: await self._pace()
+            slot = self.slot(method)
+            try:
+                async with slot, self.dc_slot(dc):
+                    self.stats["calls"] += 1; start = time.perf_counter()
+                    try: res = await call()
+                    except Exception as e: metrics.inc("tg_emoji_rpc_errors_total", method=method, error=type(e).__name__); raise
+                    finally: record_time("rpc", method, time.perf_counter() - start)
+                slot.success(); return res
+            except pyrogram.errors.FloodWait as e:
+                self.stats["flood_waits"] += 1; slot.shrink()
+                self.blocked_until[method] = max(self.blocked_until.get(method, 0), time.monotonic() + e.value)
+                logger.warning(f"FloodWait {e.value}s on {method}; concurrency now {slot.cur}")
+                if time.monotonic() + e.value > end:
+                    self.stats["deferred"] += 1; report_issue("deferred", method, item, retry_after=e.value); raise
+                self.stats["retries"] += 1
+
+    async def invoke(self, app, query, item=None):
+        return await self.run(type(query).__name__, lambda: app.invoke(query), item=item)
+
+    async def download(self, app, d, file_id, path):
+        # pyrogram's get_file logs and swallows every error, FloodWait included, and returns None, so a download
+        # wait never reaches us: downloads are only bounded by the "download" and per-DC concurrency limits
+        async with self.slot("download"), self.dc_slot(d.dc_id):
+            self.stats["calls"] += 1; start = time.perf_counter()
+            try: return await app.download_media(file_id, file_name=path)
+            finally: record_time("rpc", "download", time.perf_counter() - start)
+
+RPC_LIMITS = {"default": 8, "SearchCustomEmoji": 8, "GetCustomEmojiDocuments": 3, "GetStickerSet": 4, "download": 8}
+rpc_scheduler = RpcScheduler(rate=float(os.environ.get("TG_RPC_RATE", "30")), burst=60, limits=RPC_LIMITS, dc_limit=8, deadline=30.0)
+
+media_cache = MediaCache(MEDIA_DIR, int(os.environ.get("MEDIA_CACHE_MB", "256")) * 1024 * 1024)
+
 def get_tg_client():
     api_id, api_hash = os.environ.get("TG_API_ID"), os.environ.get("TG_API_HASH")
     if not api_id or not api_hash: return None
-    return Client(SESSION_FILE, api_id=int(api_id), api_hash=api_hash, password=os.environ.get("SESSION_PASSWORD"), device_model="MCP Server")
+    load_pyrogram()
+    return Client(SESSION_FILE, api_id=int(api_id), api_hash=api_hash, password=os.environ.get("SESSION_PASSWORD"), device_model="MCP Server", no_updates=True, sleep_threshold=0, max_concurrent_transmissions=RPC_LIMITS["download"])
+
+async def get_client():
+    """Returns the process-wide connected client, reconnecting if the last health check failed."""
+    async with tg_lock:
+        c = tg_state["client"]
+        if c and c.is_connected and tg_state["authorized"]:
+            if time.monotonic() - tg_state["checked_at"] < CLIENT_HEALTH_INTERVAL: return c
+            try: await c.get_me(); tg_state["checked_at"] = time.monotonic(); return c
+            except Exception as e: logger.warning(f"Telegram health check failed, reconnecting: {e}")
+        await _drop_client()
+        c = get_tg_client()
+        if not c: return None
+        try:
+            authorized = await c.connect() and bool(await c.get_me())
+        except Exception:
+            if c.is_connected: await c.disconnect()
+            raise
+        tg_state.update({"client": c, "authorized": authorized, "checked_at": time.monotonic()})
+        return c
+
+async def _drop_client():
+    c = tg_state["client"]; tg_state.update({"client": None, "authorized": False, "checked_at": 0.0})
+    if c and c.is_connected:
+        try: await c.disconnect()
+        except: pass
+
+async def reset_client():
+    async with tg_lock: await _drop_client()
+
+async def shutdown():
+    global web_app_runner, web_server_task
+    for task in (index_refresh_task, update_task, prewarm_task):
+        if task: task.cancel()
+    await reset_client()
+    for session in list(picker_sessions.values()): close_picker_session(session)
+    if web_server_task and not web_server_task.done(): web_server_task.cancel()
+    if web_app_runner: await web_app_runner.cleanup(); web_app_runner = None
+    web_server_task = None
+    cleanup_downloads(PICKER_TIMEOUT); media_cache.flush(); emoji_index.close()
+
+def doc_stickerset(d):
+    return next((a.stickerset for a in getattr(d, 'attributes', []) if getattr(getattr(a, 'stickerset', None), 'id', None)), None)
+
+async def resolve_pack_names(app, docs):
+    """Maps set id -> short_name for the given documents, one GetStickerSet per unknown or stale set."""
+    global stickerset_cache
+    if stickerset_cache is None: stickerset_cache = load_json(STICKERSETS_FILE, {})
+    now = time.time()
+    sets = {ss.id: ss for ss in filter(None, map(doc_stickerset, docs))}
+    stale = {sid: ss for sid, ss in sets.items() if now - stickerset_cache.get(str(sid), {}).get("checked_at", 0) > STICKERSET_TTL}
+    metrics.inc("tg_emoji_cache_requests_total", len(sets) - len(stale), cache="stickersets", result="hit")
+    metrics.inc("tg_emoji_cache_requests_total", len(stale), cache="stickersets", result="miss")
+
+    async def resolve_one(sid, ss):
+        entry = stickerset_cache.get(str(sid))
+        try:
+            r = await rpc_scheduler.invoke(app, GetStickerSet(stickerset=ss, hash=entry["hash"] if entry else 0), item=sid)
+            if isinstance(r, StickerSetNotModified) and entry: entry["checked_at"] = now
+            else: stickerset_cache[str(sid)] = {"short_name": r.set.short_name, "hash": r.set.hash, "checked_at": now}
+            return True
+        except Exception as e: logger.warning(f"GetStickerSet {sid} failed: {e}"); report_failure("GetStickerSet", sid, e); return False
+
+    with span("stickersets"): changed = stale and any(await asyncio.gather(*(resolve_one(sid, ss) for sid, ss in stale.items())))
+    names = {sid: stickerset_cache[str(sid)]["short_name"] for sid in sets if str(sid) in stickerset_cache}
+    if changed:
+        save_json(STICKERSETS_FILE, stickerset_cache)
+        try: emoji_index.add_pack_names(names)
+        except Exception as e: logger.warning(f"Failed to update emoji index: {e}")
+    return names
+
+async def search_emoticon(app, em):
+    """Returns all document ids for an emoticon, sending the cached list hash so unchanged lists are not resent."""
+    global search_cache
+    if search_cache is None: search_cache = load_json(SEARCH_CACHE_FILE, {}) if SEARCH_CACHE_PERSIST else {}
+    entry = search_cache.get(em)
+    try:
+        res = await rpc_scheduler.invoke(app, SearchCustomEmoji(emoticon=em, hash=entry["hash"] if entry else 0), item=em)
+        if isinstance(res, EmojiListNotModified) and entry:
+            metrics.inc("tg_emoji_cache_requests_total", cache="search", result="hit"); return entry["ids"]
+        if isinstance(res, EmojiList):
+            metrics.inc("tg_emoji_cache_requests_total", cache="search", result="miss")
+            search_cache[em] = {"hash": res.hash, "ids": list(res.document_id)}
+            return search_cache[em]["ids"]
+    except Exception as e: logger.warning(f"SearchCustomEmoji {em} failed: {e}"); report_failure("SearchCustomEmoji", em, e)
+    return entry["ids"] if entry else []
+
+async def search_emoticons(app, emoticons, limit):
+    """Searches all emoticons in parallel, returning {emoticon: ids[:limit]} for those with results."""
+    before = {em: (search_cache or {}).get(em, {}).get("hash") for em in emoticons}
+    with span("search"): results = await asyncio.gather(*(search_emoticon(app, em) for em in emoticons))
+    if SEARCH_CACHE_PERSIST and any(search_cache.get(em, {}).get("hash") != h for em, h in before.items()):
+        save_json(SEARCH_CACHE_FILE, search_cache)
+    return {em: ids[:limit] for em, ids in zip(emoticons, results) if ids}
+
+async def get_documents(app, ids, refresh=False):
+    """Returns {id: Document}, fetching only uncached ids with parallel GetCustomEmojiDocuments chunks."""
+    ids = list(dict.fromkeys(ids))
+    missing = ids if refresh else [i for i in ids if i not in doc_cache]
+    if not refresh:
+        metrics.inc("tg_emoji_cache_requests_total", len(ids) - len(missing), cache="documents", result="hit")
+        metrics.inc("tg_emoji_cache_requests_total", len(missing), cache="documents", result="miss")
+    chunks = [missing[i:i + DOC_CHUNK] for i in range(0, len(missing), DOC_CHUNK)]
+    calls = (rpc_scheduler.invoke(app, GetCustomEmojiDocuments(document_id=c), item=f"{len(c)} documents from {c[0]}") for c in chunks)
+    with span("documents"): results = await asyncio.gather(*calls, return_exceptions=True)
+    for c, res in zip(chunks, results):
+        if isinstance(res, BaseException):
+            logger.warning(f"GetCustomEmojiDocuments failed: {res}"); report_failure("GetCustomEmojiDocuments", f"{len(c)} documents from {c[0]}", res); continue
+        for d in res: doc_cache.pop(d.id, None); doc_cache[d.id] = d
+    # Re-insert every requested document so the oldest entries are the least recently used ones
+    found = {i: doc_cache.pop(i) for i in ids if i in doc_cache}; doc_cache.update(found)
+    while len(doc_cache) > DOC_CACHE_MAX: doc_cache.pop(next(iter(doc_cache)))
+    return found
+
+def doc_file_id(d, thumb=None):
+    if thumb: return FileId(file_type=FileType.THUMBNAIL, dc_id=d.dc_id, media_id=d.id, access_hash=d.access_hash, file_reference=d.file_reference, thumbnail_file_type=FileType.THUMBNAIL, thumbnail_source=ThumbnailSource.THUMBNAIL, thumbnail_size=thumb, volume_id=0, local_id=0).encode()
+    return FileId(file_type=FileType.STICKER, dc_id=d.dc_id, media_id=d.id, access_hash=d.access_hash, file_reference=d.file_reference).encode()
+
+async def download_document(app, d, path, thumb=None):
+    """Downloads a document (or its `thumb` size) to path, refreshing an expired file_reference and retrying once."""
+    for attempt in range(2):
+        try:
+            if await rpc_scheduler.download(app, d, doc_file_id(d, thumb), path): return path
+        except Exception as e: logger.warning(f"Download of {d.id} failed: {e}"); report_failure("download", d.id, e); return None
+        # pyrogram logs and swallows download errors, so any failure may be a stale reference
+        if attempt: break
+        fresh = (await get_documents(app, [d.id], refresh=True)).get(d.id)
+        if not fresh or fresh.file_reference == d.file_reference: break
+        d = fresh
+    logger.warning(f"Download of {d.id} failed"); report_issue("failed", "download", d.id, error="download returned no data")
+    return None
+
+def doc_media_name(d):
+    mime = getattr(d, 'mime_type', '')
+    return f"emoji_{d.id}" + (".webm" if mime == 'video/webm' else (".tgs" if mime == 'application/x-tgsticker' else ".webp"))
+
+async def fetch_media(app, d):
+    """Makes sure the full sticker is cached and returns the picker message describing it, or None."""
+    fname = doc_media_name(d)
+    if not await media_cache.fetch(fname, lambda tmp: download_document(app, d, tmp)): return None
+    ext = fname.rsplit(".", 1)[1]
+    return {"id": str(d.id), "type": ext, "src": f"/lottie/{fname}" if ext == "tgs" else f"/media/{fname}"}
+
+async def fetch_thumb(app, d):
+    """Caches the smallest downloadable thumbnail of a document; falls back to the full media if it has none."""
+    thumb = min((t for t in getattr(d, 'thumbs', None) or [] if isinstance(t, PhotoSize)), key=lambda t: t.size, default=None)
+    if not thumb: return await fetch_media(app, d)
+    fname = f"thumb_{d.id}_{thumb.type}.webp"
+    if not await media_cache.fetch(fname, lambda tmp: download_document(app, d, tmp, thumb.type)): return None
+    return {"id": str(d.id), "type": "webp", "src": f"/media/{fname}", "thumb": True}
+
+# JPEG header for Telegram's stripped thumbnails, ported from tdesktop (Ui::Images::FromInlineBytes)
+STRIPPED_JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00\xff\xdb\x00C\x00(\x1c\x1e#\x1e\x19(#!#-+(0<dA<77<{X]Id\x91\x80\x99\x96\x8f\x80\x8c\x8a\xa0\xb4\xe6\xc3\xa0\xaa\xda\xad\x8a\x8c\xc8\xff\xcb\xda\xee\xf5\xff\xff\xff\x9b\xc1\xff\xff\xff\xfa\xff\xe6\xfd\xff\xf8\xff\xdb\x00C\x01+--<5<vAAv\xf8\xa5\x8c\xa5\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xf8\xff\xc0\x00\x11\x08\x00\x00\x00\x00\x03\x01"\x00\x02\x11\x01\x03\x11\x01\xff\xc4\x00\x1f\x00\x00\x01\x05\x01\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\xff\xc4\x00\xb5\x10\x00\x02\x01\x03\x03\x02\x04\x03\x05\x05\x04\x04\x00\x00\x01}\x01\x02\x03\x00\x04\x11\x05\x12!1A\x06\x13Qa\x07"q\x142\x81\x91\xa1\x08#B\xb1\xc1\x15R\xd1\xf0$3br\x82\t\n\x16\x17\x18\x19\x1a%&\'()*456789:CDEFGHIJSTUVWXYZcdefghijstuvwxyz\x83\x84\x85\x86\x87\x88\x89\x8a\x92\x93\x94\x95\x96\x97\x98\x99\x9a\xa2\xa3\xa4\xa5\xa6\xa7\xa8\xa9\xaa\xb2\xb3\xb4\xb5\xb6\xb7\xb8\xb9\xba\xc2\xc3\xc4\xc5\xc6\xc7\xc8\xc9\xca\xd2\xd3\xd4\xd5\xd6\xd7\xd8\xd9\xda\xe1\xe2\xe3\xe4\xe5\xe6\xe7\xe8\xe9\xea\xf1\xf2\xf3\xf4\xf5\xf6\xf7\xf8\xf9\xfa\xff\xc4\x00\x1f\x01\x00\x03\x01\x01\x01\x01\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\xff\xc4\x00\xb5\x11\x00\x02\x01\x02\x04\x04\x03\x04\x07\x05\x04\x04\x00\x01\x02w\x00\x01\x02\x03\x11\x04\x05!1\x06\x12AQ\x07aq\x13"2\x81\x08\x14B\x91\xa1\xb1\xc1\t#3R\xf0\x15br\xd1\n\x16$4\xe1%\xf1\x17\x18\x19\x1a&\'()*56789:CDEFGHIJSTUVWXYZcdefghijstuvwxyz\x82\x83\x84\x85\x86\x87\x88\x89\x8a\x92\x93\x94\x95\x96\x97\x98\x99\x9a\xa2\xa3\xa4\xa5\xa6\xa7\xa8\xa9\xaa\xb2\xb3\xb4\xb5\xb6\xb7\xb8\xb9\xba\xc2\xc3\xc4\xc5\xc6\xc7\xc8\xc9\xca\xd2\xd3\xd4\xd5\xd6\xd7\xd8\xd9\xda\xe2\xe3\xe4\xe5\xe6\xe7\xe8\xe9\xea\xf2\xf3\xf4\xf5\xf6\xf7\xf8\xf9\xfa\xff\xda\x00\x0c\x03\x01\x00\x02\x11\x03\x11\x00?\x00'
+SVG_PATH_LOOKUP = "AACAAAAHAAALMAAAQASTAVAAAZaacaaaahaaalmaaaqastava.az0123456789-,"
+
+def inline_preview_html(d):
+    """Builds an instant placeholder from thumbnails embedded in the document, with no download."""
+    for t in getattr(d, 'thumbs', None) or []:
+        if isinstance(t, PhotoPathSize):
+            path = "M" + "".join(SVG_PATH_LOOKUP[c - 192] if c >= 192 else ("," if c >= 128 else "-" if c >= 64 else "") + str(c & 63) for c in t.bytes) + "z"
+            return f"<svg class='ph' viewBox='0 0 512 512'><path d='{path}' fill='#475569'/></svg>"
+    for t in getattr(d, 'thumbs', None) or []:
+        if isinstance(t, PhotoStrippedSize) and len(t.bytes) > 3 and t.bytes[0] == 1:
+            header = bytearray(STRIPPED_JPEG_HEADER); header[164], header[166] = t.bytes[1], t.bytes[2]
+            jpg = base64.b64encode(bytes(header) + t.bytes[3:] + b"\xff\xd9").decode()
+            return f"<img class='ph' src='data:image/jpeg;base64,{jpg}'>"
+    return "<div class='ph'></div>"
+
+def pack_name_of(d, pack_names):
+    ss = doc_stickerset(d)
+    return pack_names.get(ss.id, "") if ss else ""
+
+def doc_is_animated(d): return getattr(d, 'mime_type', '') in ('video/webm', 'application/x-tgsticker')
+
+async def plan_query(app, emoticons, limit, pack_name=None, is_animated=None, resolve_packs=True):
+    """Picks up to `limit` documents per emoticon that pass the filters using metadata only, no media I/O.
+
+    Candidates are examined page by page so a filtered query keeps pulling results until `limit` is filled.
+    Returns ({emoticon: [Document]}, {set_id: short_name}); emoticons with no search results are omitted.
+    With resolve_packs=False, pack names are only those a pack_name filter had to look up.
+    """
+    query_to_ids = await search_emoticons(app, emoticons, None)
+    selected, pack_names = {em: [] for em in query_to_ids}, {}
+    page = limit if pack_name is None and is_animated is None else max(limit, DOC_CHUNK)
+    offset = 0
+    while pending := {em: ids[offset:offset + page] for em, ids in query_to_ids.items() if len(selected[em]) < limit and offset < len(ids)}:
+        docs = await get_documents(app, [i for ids in pending.values() for i in ids])
+        if is_animated is not None: docs = {i: d for i, d in docs.items() if doc_is_animated(d) == is_animated}
+        if pack_name:
+            pack_names.update(await resolve_pack_names(app, docs.values()))
+            docs = {i: d for i, d in docs.items() if pack_name.lower() in pack_name_of(d, pack_names).lower()}
+        for em, ids in pending.items():
+            selected[em].extend(docs[i] for i in ids if i in docs)
+            del selected[em][limit:]
+        offset += page
+    if resolve_packs: pack_names.update(await resolve_pack_names(app, [d for docs in selected.values() for d in docs]))
+    try:
+        with span("index_update"): emoji_index.add_search(query_to_ids)
+    except Exception as e: logger.warning(f"Failed to update emoji index: {e}")
+    return selected, pack_names
+
+async def sync_installed_packs(app):
+    """Pulls the account's installed custom-emoji packs into the index, skipping sets whose hash is unchanged."""
+    r = await rpc_scheduler.invoke(app, GetEmojiStickers(hash=emoji_index.meta("emoji_stickers_hash") or 0))
+    if isinstance(r, AllStickersNotModified): return
+    for s in r.sets:
+        if emoji_index.set_hash(s.id) == s.hash: continue
+        full = await rpc_scheduler.invoke(app, GetStickerSet(stickerset=InputStickerSetID(id=s.id, access_hash=s.access_hash), hash=0))
+        emoji_index.add_set(full)
+    emoji_index.drop_sets_except({s.id for s in r.sets})
+    emoji_index.meta("emoji_stickers_hash", r.hash)
+    logger.info(f"Emoji index synced with {len(r.sets)} installed packs")
+
+async def refresh_index_loop():
+    while True:
+        try:
+            app = await get_client()
+            if app and tg_state["authorized"]: await sync_installed_packs(app)
+        except Exception as e: logger.warning(f"Emoji index refresh failed: {e}")
+        await asyncio.sleep(INDEX_REFRESH_INTERVAL)
+
+def start_index_refresh():
+    global index_refresh_task
+    if not index_refresh_task or index_refresh_task.done(): index_refresh_task = detached(refresh_index_loop())
 
 async def check_for_updates():
     global _update_checked
     if _update_checked: return
     _update_checked = True
+    start = time.perf_counter()
     try:
+        await asyncio.to_thread(load_aiohttp)
         async with ClientSession() as s:
             async with s.get(f"https://pypi.org/pypi/{PACKAGE_NAME}/json", timeout=3) as r:
                 if r.status == 200:
@@ -98,14 +762,41 @@ async def check_for_updates():
                     if latest != VERSION:
                         logger.info(f"Update available: {latest} (current {VERSION}). Run: uvx --refresh {PACKAGE_NAME}")
     except: pass
+    record_time("phase", "check_for_updates", time.perf_counter() - start)
+
+def start_update_check():
+    """Runs the PyPI check as a fire-and-forget task."""
+    global update_task
+    if UPDATE_CHECK and not update_task: update_task = detached(check_for_updates())
+
+async def prewarm_client():
+    """Imports pyrogram off the event loop and, with TG_PREWARM=1, connects so the first tool call finds a ready client."""
+    loop = asyncio.get_running_loop()
+
+    def load():
+        # pyrogram.sync calls get_event_loop() at import time, which fails in a worker thread without a loop
+        asyncio.set_event_loop(loop); load_pyrogram()
+
+    try:
+        await asyncio.to_thread(load)
+        if PREWARM and await get_client() and tg_state["authorized"]: start_index_refresh()
+    except Exception as e: logger.warning(f"Telegram pre-warm failed: {e}")
+
+def start_prewarm():
+    global prewarm_task
+    if not prewarm_task: prewarm_task = detached(prewarm_client())
 
 async def ensure_authorized():
+    with span("ensure_authorized"): return await _ensure_authorized()
+
+async def _ensure_authorized():
     global auth_session, config_update_future
-    client = get_tg_client()
-    if not client: auth_session["step"] = "config"; await open_auth_page(); return False
     try:
-        await client.connect()
-        if await client.get_me(): await client.disconnect(); return True
+        client = await get_client()
+        if not client: auth_session["step"] = "config"; await open_auth_page(); return False
+        if tg_state["authorized"]: start_index_refresh(); return True
+        # Hand the unauthorized connection over to the browser login flow
+        async with tg_lock: tg_state.update({"client": None, "authorized": False})
         auth_session.update({"step": "phone", "client": client}); await open_auth_page(); return False
     except Exception as e:
         if "AUTH_KEY_UNREGISTERED" in str(e):
@@ -113,18 +804,18 @@ async def ensure_authorized():
                 p = SESSION_FILE + ext
                 if os.path.exists(p): os.remove(p)
         auth_session.update({"step": "config", "error": str(e)}); await open_auth_page(); return False
-    finally:
-        if client and client.is_connected: await client.disconnect()
 
 async def open_auth_page():
-    global web_app_runner, web_server_port, config_update_future
-    url = f"http://127.0.0.1:{web_server_port}/auth" if web_app_runner else await start_web_server() + "/auth"
+    global config_update_future
+    url = await start_web_server() + "/auth"
     webbrowser.open(url)
     if not config_update_future or config_update_future.done(): config_update_future = asyncio.Future()
 
 async def wait_for_auth():
     global config_update_future
-    try: await asyncio.wait_for(config_update_future, 600.0); return True
+    try:
+        with span("wait_for_auth"): await asyncio.wait_for(config_update_future, 600.0)
+        return True
     except: return False
 
 # --- Web ---
@@ -147,8 +838,8 @@ async def handle_auth_config(request):
     if aid.isdigit() and len(ah)>10:
         set_key(ENV_FILE, "TG_API_ID", aid); set_key(ENV_FILE, "TG_API_HASH", ah); os.environ.update({"TG_API_ID": aid, "TG_API_HASH": ah})
         auth_session.update({"step": "phone", "error": None})
-        if auth_session["client"]: await auth_session["client"].disconnect()
-        auth_session["client"] = get_tg_client()
+        if auth_session["client"] and auth_session["client"].is_connected: await auth_session["client"].disconnect()
+        await reset_client(); auth_session["client"] = get_tg_client()
     else: auth_session["error"] = "Invalid API data"
     return web.HTTPFound('/auth')
 
@@ -190,34 +881,138 @@ async def handle_auth_password(request):
 # --- MCP Tool Logic ---
 
 async def handle_selection(request):
-    global selected_emoji_future
+    session = picker_sessions.get(request.match_info["id"])
+    if not session: return web.Response(status=404, text="Selection session expired")
     try:
         data = await request.json()
-        if selected_emoji_future and not selected_emoji_future.done():
-            selected_emoji_future.set_result(data)
+        if not session["future"].done(): session["future"].set_result(data)
         return web.Response(text="OK")
     except Exception as e: return web.Response(status=400, text=str(e))
 
+def new_picker_session():
+    """Registers a picker page with its own staging directory, event stream and selection future."""
+    sid = uuid.uuid4().hex
+    session = {"id": sid, "dir": os.path.join(DOWNLOADS_DIR, sid), "future": asyncio.get_running_loop().create_future(),
+               "stream": {"events": [], "changed": asyncio.Event(), "done": False},
+               "trace": call_timings.get(), "issues": rpc_issues.get()}
+    os.makedirs(session["dir"], exist_ok=True); picker_sessions[sid] = session
+    return session
+
+def close_picker_session(session):
+    """Ends one picker page: closes its event stream and removes only its staging directory."""
+    picker_sessions.pop(session["id"], None); close_picker_stream(session["stream"])
+    if not session["future"].done(): session["future"].cancel()
+    shutil.rmtree(session["dir"], ignore_errors=True)
+
+def publish_event(stream, data):
+    """Appends a JSON message (dict or pre-serialized str) to the stream and wakes its /events subscribers."""
+    stream["events"].append(data if isinstance(data, str) else json.dumps(data))
+    changed, stream["changed"] = stream["changed"], asyncio.Event(); changed.set()
+
+def close_picker_stream(stream):
+    if stream and not stream["done"]: publish_event(stream, {"done": True}); stream["done"] = True
+
+async def handle_events(request):
+    session = picker_sessions.get(request.match_info["id"])
+    if not session: return web.Response(status=404)
+    stream = session["stream"]
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request); sent = 0
+    try:
+        while True:
+            changed, pending = stream["changed"], stream["events"][sent:]
+            for data in pending: await resp.write(f"data: {data}\n\n".encode())
+            sent += len(pending)
+            if stream["done"] and sent == len(stream["events"]): break
+            await changed.wait()
+    except ConnectionResetError: pass
+    return resp
+
+async def handle_full_media(request):
+    """Downloads the full sticker behind a thumbnail card on demand and describes it for the page.
+
+    The work is charged to the picker call that owns the page, not to whichever call started the server.
+    """
+    session = picker_sessions.get(request.match_info["sid"])
+    try: d = doc_cache.get(int(request.match_info["id"]))
+    except ValueError: d = None
+    if not d or not session: return web.Response(status=404)
+    app = await get_client()
+    if not app or not tg_state["authorized"]: return web.Response(status=503)
+    tokens = call_timings.set(session["trace"]), rpc_issues.set(session["issues"])
+    try:
+        with span("full_media"): msg = await fetch_media(app, d)
+    finally: call_timings.reset(tokens[0]); rpc_issues.reset(tokens[1])
+    media_cache.flush()
+    return web.json_response(msg) if msg else web.Response(status=502)
+
+async def handle_lottie(request):
+    """Serves a cached .tgs as Lottie JSON; the file is already gzip, so the browser inflates it."""
+    name = request.match_info["name"]
+    p = media_cache.get(name) if name.endswith(".tgs") else None
+    if not p: return web.Response(status=404)
+    return web.FileResponse(p, headers={"Content-Type": "application/json", "Content-Encoding": "gzip", "Cache-Control": "max-age=86400"})
+
+async def handle_lottie_player(request):
+    """Serves lottie.min.js from BASE_DIR, fetching it once so later pages work offline."""
+    if not os.path.exists(LOTTIE_JS_FILE):
+        try:
+            async with ClientSession() as s:
+                async with s.get(LOTTIE_JS_URL, timeout=10) as r:
+                    r.raise_for_status(); body = await r.read()
+            tmp = f"{LOTTIE_JS_FILE}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f: f.write(body)
+            os.replace(tmp, LOTTIE_JS_FILE)
+        except Exception as e: logger.warning(f"Failed to fetch lottie player: {e}"); return web.Response(status=503)
+    return web.FileResponse(LOTTIE_JS_FILE, headers={"Content-Type": "application/javascript", "Cache-Control": "max-age=86400"})
+
+async def handle_metrics(request):
+    """Prometheus scrape endpoint: call/phase/RPC latency histograms, cache hit counters and transfer totals."""
+    mc = media_cache.summary()
+    extra = [("counter", "tg_emoji_cache_requests_total", (("cache", "media"), ("result", r)), mc[k]) for r, k in (("hit", "hits"), ("miss", "misses"))]
+    extra += [("counter", "tg_emoji_media_cache_evictions_total", (), mc["evictions"]), ("counter", "tg_emoji_downloaded_bytes_total", (), mc["downloaded_bytes"]),
+              ("gauge", "tg_emoji_media_cache_bytes", (), mc["bytes"]), ("gauge", "tg_emoji_media_cache_max_bytes", (), mc["max_bytes"]),
+              ("gauge", "tg_emoji_media_cache_entries", (), mc["entries"]), ("gauge", "tg_emoji_document_cache_entries", (), len(doc_cache))]
+    extra += [("counter", f"tg_emoji_rpc_{k}_total", (), v) for k, v in rpc_scheduler.stats.items()]
+    extra += [("gauge", "tg_emoji_rpc_concurrency", (("method", m),), s.cur) for m, s in rpc_scheduler.slots.items()]
+    return web.Response(body=metrics.render(extra).encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 async def start_web_server():
+    """Returns the base URL of the shared web server, starting it once however many callers race here."""
+    global web_server_task
+    # Request handlers inherit the context the server starts in, which is often a tool call's
+    if not web_server_task: web_server_task = detached(serve_web())
+    try: return await asyncio.shield(web_server_task)
+    except Exception:
+        if web_server_task.done(): web_server_task = None
+        raise
+
+async def serve_web():
     global web_app_runner, web_server_port
-    app = web.Application(); os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    load_aiohttp(); app = web.Application(); os.makedirs(DOWNLOADS_DIR, exist_ok=True)
     app.router.add_static('/static', path=DOWNLOADS_DIR, name='static')
-    app.router.add_post('/select', handle_selection)
+    os.makedirs(MEDIA_DIR, exist_ok=True); app.router.add_static('/media', path=MEDIA_DIR, name='media')
+    app.router.add_post('/select/{id}', handle_selection); app.router.add_get('/events/{id}', handle_events)
+    app.router.add_get('/lottie/{name}', handle_lottie); app.router.add_get('/lottie.js', handle_lottie_player)
+    app.router.add_get('/full/{sid}/{id}', handle_full_media); app.router.add_get('/metrics', handle_metrics)
     app.router.add_get('/auth', handle_auth_get); app.router.add_post('/auth/config', handle_auth_config)
     app.router.add_post('/auth/phone', handle_auth_phone); app.router.add_post('/auth/code', handle_auth_code)
     app.router.add_post('/auth/password', handle_auth_password)
-    app.router.add_get('/', lambda r: web.HTTPFound('/static/index.html'))
+    app.router.add_get('/', lambda r: web.HTTPFound(f'/static/{next(reversed(picker_sessions))}/index.html' if picker_sessions else '/auth'))
     runner = web.AppRunner(app); await runner.setup()
-    site = web.TCPSite(runner, '127.0.0.1', 0); await site.start()
+    site = web.TCPSite(runner, '127.0.0.1', int(os.environ.get("WEB_PORT") or 0)); await site.start()
     web_server_port = site._server.sockets[0].getsockname()[1]; web_app_runner = runner
     return f"http://127.0.0.1:{web_server_port}"
 
-@mcp.tool()
+@report_rpc_issues
+@traced
 async def search_and_select_emoji(
     emoticons: list[str], 
     limit: int = 10, 
     pack_name: str = None, 
-    is_animated: bool = None
+    is_animated: bool = None,
+    preview: bool = True,
+    timings: bool = False
 ) -> dict:
     """
     Interactive search for Telegram emojis.
@@ -225,171 +1020,186 @@ async def search_and_select_emoji(
         emoticons: List of symbols (e.g. 🔥, 💎). CRITICAL: NO TEXT NAMES.
         limit: Max results per symbol (max 50).
         is_animated: Set to True for animated/video stickers. HIGHLY RECOMMENDED.
+        preview: Show small static thumbnails first; the full animation loads on hover or selection.
+        timings: Add a per-phase and per-RPC latency breakdown to the result.
     """
-    global selected_emoji_future
-    cleanup_downloads(); await check_for_updates()
+    start_update_check()
     if not await ensure_authorized() and not await wait_for_auth(): return {"error": "Auth failed"}
     
-    app = get_tg_client()
-    async with app:
-        try:
-            # 1. Parallel search for all emoticons
-            async def search_one(em):
-                try:
-                    res = await app.invoke(SearchCustomEmoji(emoticon=em, hash=0))
-                    if isinstance(res, EmojiList) and res.document_id:
-                        return em, res.document_id[:limit]
-                except: pass
-                return em, []
-
-            search_results = await asyncio.gather(*(search_one(em) for em in emoticons))
-            query_to_ids = {em: ids for em, ids in search_results if ids}
-            all_found_ids = [idx for ids in query_to_ids.values() for idx in ids]
-            
-            if not all_found_ids: return {"error": "No emojis found."}
-            
-            # 2. Get info for all found stickers in one call
-            all_docs = await app.invoke(GetCustomEmojiDocuments(document_id=list(set(all_found_ids))))
-            doc_map = {d.id: d for d in all_docs}
-            
-            # 3. Parallel download of stickers with limit
-            semaphore = asyncio.Semaphore(10)
-            async def download_one(d):
-                async with semaphore:
-                    try:
-                        mime = getattr(d, 'mime_type', '')
-                        is_anim = mime in ('video/webm', 'application/x-tgsticker')
-                        if (is_animated is not None and is_animated != is_anim): return None
-                        
-                        ext = ".webm" if mime == 'video/webm' else (".tgs" if mime == 'application/x-tgsticker' else ".webp")
-                        fname = f"emoji_{d.id}{ext}"
-                        local_p = os.path.join(DOWNLOADS_DIR, fname)
-                        if not os.path.exists(local_p):
-                            await app.download_media(FileId(file_type=FileType.STICKER, dc_id=d.dc_id, media_id=d.id, access_hash=d.access_hash, file_reference=d.file_reference).encode(), file_name=local_p)
-                        
-                        # Pack name
-                        p_name = ""
-                        for a in d.attributes:
-                            if hasattr(a, 'stickerset'):
-                                try:
-                                    s = await app.invoke(pyrogram.raw.functions.messages.GetStickerSet(stickerset=a.stickerset, hash=0))
-                                    p_name = s.set.short_name
-                                except: pass
-                        
-                        if pack_name and pack_name.lower() not in p_name.lower(): return None
-                        
-                        return {
-                            "id": str(d.id), "pack_name": p_name, "is_animated": is_anim, 
-                            "local_file_path": os.path.abspath(local_p), "filename": fname
-                        }
-                    except: return None
-
-            download_tasks = [download_one(doc_map[doc_id]) for doc_id in set(all_found_ids) if doc_id in doc_map]
-            downloaded_details = await asyncio.gather(*download_tasks)
-            details_map = {det['id']: det for det in downloaded_details if det}
-            
-            # --- UI Generation ---
-            sections_h = ""
-            for em_query, ids in query_to_ids.items():
-                items_h = ""
-                for doc_id in ids:
-                    det = details_map.get(str(doc_id))
-                    if not det: continue
-                    
-                    media = f"<video autoplay loop muted src='{det['filename']}'></video>" if det['filename'].endswith('.webm') else (f"<img src='{det['filename']}'>" if not det['filename'].endswith('.tgs') else f"<div id='l_{det['id']}'></div><script>lottie.loadAnimation({{container:document.getElementById('l_{det['id']}'),renderer:'canvas',loop:true,autoplay:true,animationData:{gzip.open(det['local_file_path'],'rt').read()}}})</script>")
-                    items_h += f"""<div class='card' onclick='t("{det['id']}", "{em_query}")' id='c_{det['id']}'>
-                        <div class='checkbox-box'><input type='radio' name='group_{em_query}' id='i_{det['id']}' data-id='{det['id']}' data-query='{em_query}'></div>
-                        {media}<div class='pname'>{det['pack_name']}</div></div>"""
-                
-                if items_h:
-                    sections_h += f"<div class='section'><h3>{em_query}</h3><div class='grid'>{items_h}</div></div>"
-
-            if not sections_h: return {"error": "No results found after filtering"}
-
-            html = f"""<!DOCTYPE html><html><head><meta charset='utf-8'><script src='https://cdnjs.cloudflare.com/ajax/libs/bodymovin/5.12.2/lottie.min.js'></script><style>
-                body{{background:#0f172a;color:white;font-family:sans-serif;margin:0;padding:20px}}
-                .header{{display:flex;justify-content:space-between;align-items:center;position:sticky;top:0;background:#0f172a;padding:10px 0;z-index:100;border-bottom:1px solid #1e293b;margin-bottom:20px}}
-                .section{{margin-bottom:30px}}h3{{color:#38bdf8;border-left:4px solid #38bdf8;padding-left:15px;margin-bottom:15px}}
-                .grid{{display:grid;grid-template-columns:repeat(auto-fill,minmax(120px,1fr));gap:15px}}
-                .card{{background:#1e293b;padding:15px;border-radius:12px;cursor:pointer;border:2px solid transparent;position:relative;text-align:center;transition:0.2s}}
-                .card:hover{{background:#334155}}.card.selected{{border-color:#38bdf8;background:#0ea5e922}}
-                .checkbox-box{{position:absolute;top:8px;right:8px}}.card video, .card img, .card div{{width:64px;height:64px;margin:0 auto}}
-                .pname{{font-size:10px;color:#64748b;margin-top:8px;white-space:nowrap;overflow:hidden;text-overflow:ellipsis}}
-                .btn{{background:#0284c7;color:white;border:none;padding:12px 24px;border-radius:8px;cursor:pointer;font-weight:bold}}
-                input[type=radio]{{width:18px;height:18px;cursor:pointer}}
-            </style></head><body>
-                <div class='header'><div><h2 style='margin:0'>Emoji Selection</h2><p style='margin:5px 0 0 0;font-size:12px;color:#94a3b8'>Select one per search query</p></div><button onclick='s()' id='sub' class='btn'>Confirm</button></div>
-                {sections_h}
-                <script>
-                    function t(id, q){{
-                        document.querySelectorAll('input[data-query="'+q+'"]').forEach(rb => document.getElementById('c_'+rb.dataset.id).classList.remove('selected'));
-                        const c=document.getElementById('c_'+id), i=document.getElementById('i_'+id);
-                        i.checked=true; c.classList.add('selected');
-                    }}
-                    async function s(){{
-                        const b=document.getElementById('sub'); b.disabled=true; b.innerText='Sending...';
-                        const res=[]; document.querySelectorAll('input:checked').forEach(i=>res.push({{id:i.dataset.id,query:i.dataset.query}}));
-                        if(!res.length) {{ alert('Please select at least one!'); b.disabled=false; b.innerText='Confirm'; return; }}
-                        try {{
-                            await fetch('/select',{{method:'POST',headers:{{'Content-Type':'application/json'}},body:JSON.stringify({{selections:res}})}});
-                            window.close();
-                        }} catch(e) {{ alert('Error'); b.disabled=false; }}
-                    }}
-                </script></body></html>"""
-            
-            with open(os.path.join(DOWNLOADS_DIR, "index.html"), "w", encoding="utf-8") as f: f.write(html)
-            base_url = f"http://127.0.0.1:{web_server_port}" if web_app_runner else await start_web_server()
-            webbrowser.open(f"{base_url}/static/index.html")
+    app = await get_client()
+    if not app: return {"error": "Auth failed"}
+    try:
+        # 1. Search and filter on metadata, so only surviving emojis are downloaded
+        # Pack names only gate the page when filtering by pack; otherwise they are streamed to the cards
+        plan, pack_names = await plan_query(app, emoticons, limit, pack_name, is_animated, resolve_packs=False)
+        if not plan: return {"error": "No emojis found."}
+        if not any(plan.values()): return {"error": "No results found after filtering"}
+        doc_map = {d.id: d for docs in plan.values() for d in docs}
+        
+        # 2. Serve the page right away with placeholders; cards are filled in over /events as downloads finish
+        html_start = time.perf_counter(); session = new_picker_session(); stream, sid = session["stream"], session["id"]
+        sections_h = ""
+        for em_query, docs in plan.items():
+            items_h = ""
+            for d in docs:
+                items_h += f"""<div class='card' onclick='t("{d.id}", "{em_query}")' onmouseenter='f("{d.id}")' id='c_{d.id}'>
+                    <div class='checkbox-box'><input type='radio' name='group_{em_query}' id='i_{d.id}' data-id='{d.id}' data-query='{em_query}'></div>
+                    {inline_preview_html(d)}<div class='pname'>{pack_name_of(d, pack_names)}</div></div>"""
             
-            selected_emoji_future = asyncio.Future()
+            if items_h:
+                sections_h += f"<div class='section'><h3>{em_query}</h3><div class='grid'>{items_h}</div></div>"
+
+        html = f"""<!DOCTYPE html><html><head><meta charset='utf-8'><style>
+            body{{background:#0f172a;color:white;font-family:sans-serif;margin:0;padding:20px}}
+            .header{{display:flex;justify-content:space-between;align-items:center;position:sticky;top:0;background:#0f172a;padding:10px 0;z-index:100;border-bottom:1px solid #1e293b;margin-bottom:20px}}
+            .section{{margin-bottom:30px}}h3{{color:#38bdf8;border-left:4px solid #38bdf8;padding-left:15px;margin-bottom:15px}}
+            .grid{{display:grid;grid-template-columns:repeat(auto-fill,minmax(120px,1fr));gap:15px}}
+            .card{{background:#1e293b;padding:15px;border-radius:12px;cursor:pointer;border:2px solid transparent;position:relative;text-align:center;transition:0.2s}}
+            .card:hover{{background:#334155}}.card.selected{{border-color:#38bdf8;background:#0ea5e922}}
+            .checkbox-box{{position:absolute;top:8px;right:8px}}.card video, .card img, .card div, .card svg{{width:64px;height:64px;margin:0 auto;display:block}}
+            .ph{{border-radius:12px;background:#334155;animation:pulse 1.2s ease-in-out infinite}}@keyframes pulse{{50%{{opacity:.4}}}}
+            .pname{{font-size:10px;color:#64748b;margin-top:8px;white-space:nowrap;overflow:hidden;text-overflow:ellipsis}}
+            .btn{{background:#0284c7;color:white;border:none;padding:12px 24px;border-radius:8px;cursor:pointer;font-weight:bold}}
+            input[type=radio]{{width:18px;height:18px;cursor:pointer}}
+        </style></head><body>
+            <div class='header'><div><h2 style='margin:0'>Emoji Selection</h2><p style='margin:5px 0 0 0;font-size:12px;color:#94a3b8'>Select one per search query</p></div><button onclick='s()' id='sub' class='btn'>Confirm</button></div>
+            {sections_h}
+            <script>
+                // Animations only load and play while their card is on screen
+                const anims={{}}, io=new IntersectionObserver(entries=>entries.forEach(e=>{{
+                    const el=e.target, src=el.dataset.lottie;
+                    if(!src) return e.isIntersecting ? el.play().catch(()=>{{}}) : el.pause();
+                    let a=anims[src];
+                    if(e.isIntersecting) {{ if(a) a.play(); else if(window.lottie) anims[src]=lottie.loadAnimation({{container:el,renderer:'canvas',loop:true,autoplay:true,path:src}}); }}
+                    else if(a) a.pause();
+                }}),{{rootMargin:'100px'}});
+                // The player may take a while on first use (fetched once from cdnjs); cards keep streaming meanwhile
+                const lp=document.createElement('script'); lp.src='/lottie.js';
+                lp.onload=()=>document.querySelectorAll('[data-lottie]').forEach(el=>{{ io.unobserve(el); io.observe(el); }});
+                document.head.appendChild(lp);
+                const es=new EventSource('/events/{sid}');
+                function show(m){{
+                    const c=document.getElementById('c_'+m.id), cur=c&&c.querySelector('.ph,.media'); if(!cur) return;
+                    let el;
+                    if(m.type==='webm') {{ el=document.createElement('video'); el.loop=el.muted=true; el.src=m.src; io.observe(el); }}
+                    else if(m.type==='tgs') {{ el=document.createElement('div'); el.dataset.lottie=m.src; io.observe(el); }}
+                    else {{ el=document.createElement('img'); el.src=m.src; }}
+                    el.classList.add('media'); cur.replaceWith(el); c.dataset.thumb=m.thumb?'1':'';
+                }}
+                // Thumbnail cards swap to the full sticker on hover or selection
+                function f(id){{
+                    const c=document.getElementById('c_'+id); if(!c||!c.dataset.thumb||c.dataset.loading) return;
+                    c.dataset.loading='1'; fetch('/full/{sid}/'+id).then(r=>r.ok?r.json():null).then(m=>m&&show(m)).finally(()=>delete c.dataset.loading);
+                }}
+                es.onmessage=e=>{{
+                    const m=JSON.parse(e.data); if(m.done) {{ es.close(); return; }}
+                    if(m.packs) {{ for(const [id,n] of Object.entries(m.packs)) {{ const p=document.querySelector('#c_'+id+' .pname'); if(p) p.textContent=n; }} return; }}
+                    const c=document.getElementById('c_'+m.id); if(!c||!c.querySelector('.ph')) return;
+                    if(m.failed) c.remove(); else show(m);
+                }};
+                function t(id, q){{
+                    f(id);
+                    document.querySelectorAll('input[data-query="'+q+'"]').forEach(rb => document.getElementById('c_'+rb.dataset.id).classList.remove('selected'));
+                    const c=document.getElementById('c_'+id), i=document.getElementById('i_'+id);
+                    i.checked=true; c.classList.add('selected');
+                }}
+                async function s(){{
+                    const b=document.getElementById('sub'); b.disabled=true; b.innerText='Sending...';
+                    const res=[]; document.querySelectorAll('input:checked').forEach(i=>res.push({{id:i.dataset.id,query:i.dataset.query}}));
+                    if(!res.length) {{ alert('Please select at least one!'); b.disabled=false; b.innerText='Confirm'; return; }}
+                    try {{
+                        await fetch('/select/{sid}',{{method:'POST',headers:{{'Content-Type':'application/json'}},body:JSON.stringify({{selections:res}})}});
+                        window.close();
+                    }} catch(e) {{ alert('Error'); b.disabled=false; }}
+                }}
+            </script></body></html>"""
+        
+        with open(os.path.join(session["dir"], "index.html"), "w", encoding="utf-8") as f: f.write(html)
+        record_time("phase", "html", time.perf_counter() - html_start)
+        base_url = await start_web_server()
+        webbrowser.open(f"{base_url}/static/{sid}/index.html")
+        
+        # 3. Parallel download of selected stickers, each pushed to the page as soon as it lands
+        async def download_one(d):
             try:
-                raw_res = await asyncio.wait_for(selected_emoji_future, 300.0)
-                mapping = {sel['query']: [sel['id']] for sel in raw_res.get("selections", [])}
-                cleanup_downloads(); return {"status": "success", "selection_mapping": mapping}
-            except: return {"error": "Timeout"}
-        except Exception as e: return {"error": str(e)}
-
-@mcp.tool()
-async def search_emoji_auto(emoticons: list[str], limit: int = 5, pack_name: str = None, is_animated: bool = None) -> dict:
-    """Non-interactive search for Telegram emojis. returns mapping. Unicode symbols only."""
-    await check_for_updates()
-    if not await ensure_authorized() and not await wait_for_auth(): return {"error": "Auth failed"}
-    app = get_tg_client()
-    async with app:
+                if msg := await (fetch_thumb(app, d) if preview else fetch_media(app, d)): publish_event(stream, msg); return
+            except Exception as e: logger.warning(f"Failed to prepare {d.id}: {e}")
+            publish_event(stream, {"id": str(d.id), "failed": True})
+
+        async def publish_pack_names():
+            try: names = await resolve_pack_names(app, doc_map.values())
+            except Exception as e: logger.warning(f"Failed to resolve pack names: {e}"); return
+            if packs := {str(i): n for i, d in doc_map.items() if (n := pack_name_of(d, names))}: publish_event(stream, {"packs": packs})
+
+        async def download_media():
+            with span("downloads"): await asyncio.gather(*(download_one(d) for d in doc_map.values()))
+
+        async def download_all():
+            await asyncio.gather(publish_pack_names(), download_media())
+            close_picker_stream(stream)
+
+        downloads = asyncio.create_task(download_all())
         try:
-            # Parallel search
-            async def search_one(em):
-                try:
-                    res = await app.invoke(SearchCustomEmoji(emoticon=em, hash=0))
-                    if isinstance(res, EmojiList) and res.document_id: return em, res.document_id[:limit]
-                except: pass
-                return em, []
-
-            results = await asyncio.gather(*(search_one(em) for em in emoticons))
-            query_to_ids = {em: ids for em, ids in results if ids}
-            all_ids = [idx for ids in query_to_ids.values() for idx in ids]
-            
-            if not all_ids: return {"error": "No results"}
-            docs = await app.invoke(GetCustomEmojiDocuments(document_id=list(set(all_ids))))
-            
-            final_res = []
-            for d in docs:
-                p_name = ""
-                for a in d.attributes:
-                    if hasattr(a, 'stickerset'):
-                        try:
-                            s = await app.invoke(pyrogram.raw.functions.messages.GetStickerSet(stickerset=a.stickerset, hash=0))
-                            p_name = s.set.short_name
-                        except: pass
-                mime = getattr(d, 'mime_type', '')
-                is_anim = mime in ('video/webm', 'application/x-tgsticker')
-                if (pack_name and pack_name.lower() not in p_name.lower()) or (is_animated is not None and is_animated != is_anim): continue
-                final_res.append({"id": str(d.id), "pack_name": p_name, "is_animated": is_anim})
-            return {"status": "success", "results": final_res}
-        except Exception as e: return {"error": str(e)}
+            with span("selection"): raw_res = await asyncio.wait_for(session["future"], PICKER_TIMEOUT)
+            mapping = {sel['query']: [sel['id']] for sel in raw_res.get("selections", [])}
+            return {"status": "success", "selection_mapping": mapping}
+        except: return {"error": "Timeout"}
+        finally:
+            downloads.cancel(); close_picker_session(session)
+            media_cache.flush(); logger.info(f"Media cache: {media_cache.summary()}")
+    except Exception as e: return {"error": str(e)}
+
+@report_rpc_issues
+@traced
+async def search_emoji_auto(emoticons: list[str], limit: int = 5, pack_name: str = None, is_animated: bool = None, prefer_cache: bool = False, timings: bool = False) -> dict:
+    """Non-interactive search for Telegram emojis. returns mapping. Unicode symbols only.
+    Set prefer_cache=True to answer from the local index with no Telegram round trip when it covers every symbol.
+    Set timings=True to get a per-phase and per-RPC latency breakdown."""
+    if prefer_cache:
+        try:
+            with span("index_lookup"): indexed, ages = emoji_index.lookup(emoticons, limit, pack_name, is_animated)
+        except Exception as e: logger.warning(f"Emoji index lookup failed: {e}"); indexed, ages = {}, {}
+        hit = emoticons and len(indexed) == len(set(emoticons))
+        metrics.inc("tg_emoji_cache_requests_total", cache="index", result="hit" if hit else "miss")
+        if hit:
+            rows = {i: (p, a) for hits in indexed.values() for i, p, a in hits}
+            final_res = [{"id": str(i), "pack_name": p, "is_animated": a} for i, (p, a) in rows.items()]
+            return {"status": "success", "results": final_res, "source": "index", "index_age_seconds": ages}
+    start_update_check()
+    if not await ensure_authorized() and not await wait_for_auth(): return {"error": "Auth failed"}
+    app = await get_client()
+    if not app: return {"error": "Auth failed"}
+    try:
+        # Parallel search, filtered on metadata
+        plan, pack_names = await plan_query(app, emoticons, limit, pack_name, is_animated)
+        if not plan: return {"error": "No results"}
+        docs = {d.id: d for ds in plan.values() for d in ds}.values()
+        final_res = [{"id": str(d.id), "pack_name": pack_name_of(d, pack_names), "is_animated": doc_is_animated(d)} for d in docs]
+        return {"status": "success", "results": final_res, "source": "telegram"}
+    except Exception as e: return {"error": str(e)}
+
+def get_server():
+    """Builds the FastMCP server on first use, creating the data directories it works in."""
+    global _server
+    if _server is None:
+        from mcp.server.fastmcp import FastMCP
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        _server = FastMCP("TelegramEmojiSearch", lifespan=lifespan)
+        for tool in (search_and_select_emoji, search_emoji_auto): _server.tool()(tool)
+    return _server
+
+def __getattr__(name):
+    # Keeps `tg_emoji_mcp.mcp` available to the mcp CLI without importing mcp when the module loads
+    if name == "mcp": return get_server()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def main():
+    start = time.perf_counter()
     logger.info(f"Remoji TG MCP v{VERSION}. Data: {BASE_DIR}")
-    cleanup_downloads(); mcp.run()
+    server = get_server(); cleanup_downloads(PICKER_TIMEOUT)
+    logger.info(f"Server ready in {(time.perf_counter() - start) * 1000:.0f} ms")
+    try: server.run()
+    except KeyboardInterrupt: pass
+    finally: cleanup_downloads(PICKER_TIMEOUT); logger.info("Remoji TG MCP stopped")
 
 if __name__ == "__main__": main()